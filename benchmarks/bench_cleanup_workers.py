@@ -0,0 +1,73 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import scipy.ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from usct_vit import *
+from synthetic import SyntheticPhantom
+
+'''
+Check that the iterative Artery/Vein removal of Labelprocessing3d gives the
+same labels, removal passes and remaining vessel counts with workers>1
+(z-slab processes) as with workers=1, and time both
+'''
+
+def add_vessel_blobs(volume, blob_frac, seed=1):
+    '''
+    overlay thick Artery/Vein blobs, which take several removal rounds
+    (the tubes of SyntheticPhantom are removed by the first passes)
+    blob_frac: fraction of the volume covered by the blobs
+    '''
+    rng = np.random.default_rng(seed)
+    noise = scipy.ndimage.gaussian_filter(rng.standard_normal(volume.shape).astype('float32'), 4)
+    blobs = noise>np.quantile(noise, 1-blob_frac)
+    kind = scipy.ndimage.gaussian_filter(rng.standard_normal(volume.shape).astype('float32'), 6)
+    volume[blobs] = np.where(kind>0, Labels['Artery'], Labels['Vein'])[blobs]
+    return volume
+
+
+def run(volume, workers):
+    stats = {}
+    t0 = time.perf_counter()
+    out = Labelprocessing3d(volume.copy(order='K'), 'iterative', stats=stats, workers=workers)
+    return out, stats, time.perf_counter()-t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-size', type=int, nargs=3, default=[40, 160, 160], help="Volume size (z x y)")
+    parser.add_argument('-vessel_frac', type=float, default=0.05, help="Fraction of vessel voxels")
+    parser.add_argument('-blob_frac', type=float, default=0.1, help="Fraction of the volume covered by vessel blobs")
+    parser.add_argument('-workers', type=int, nargs='+', default=[2, 3, 7], help="Numbers of processes to compare")
+    args = parser.parse_args()
+
+    base = add_vessel_blobs(SyntheticPhantom(tuple(args.size), vessel_frac=args.vessel_frac), args.blob_frac)
+    for order in ('C', 'F'):
+        volume = np.array(base, order=order)
+        ref, ref_stats, t_ref = run(volume, 1)
+        print ('order', order, 'removal passes', ref_stats['removal_passes'],
+               'remaining vessels', ref_stats['remaining_vessels'])
+        print ('{:>10}: {:.3f} s'.format('workers 1', t_ref))
+        for w in args.workers:
+            out, stats, elapsed = run(volume, w)
+            assert np.array_equal(ref, out) # same labels as workers=1
+            assert stats['removal_passes']==ref_stats['removal_passes']
+            assert stats['remaining_vessels']==ref_stats['remaining_vessels']
+            print ('{:>10}: {:.3f} s, identical output'.format('workers %d' % w, elapsed))
@@ -0,0 +1,70 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import scipy.ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from usct_vit import *
+
+'''
+Compare the per-voxel RemoveLabelLoop with the vectorized RemoveLabel
+on a synthetic vessel-dense fat/glandular volume
+'''
+
+def vessel_volume(shape, vessel_frac, seed=0):
+    '''
+    fat/glandular background with artery and vein tubes
+    vessel_frac: fraction of voxels covered by vessels (approximately)
+    '''
+    rng = np.random.default_rng(seed)
+    noise = scipy.ndimage.gaussian_filter(rng.standard_normal(shape), 3)
+    volume = np.where(noise>0, Labels['Glandular'], Labels['Fat']).astype('uint8')
+    vessels = np.zeros(shape, bool)
+    while vessels.mean()<vessel_frac:
+        # a random straight tube along one of the axes
+        axis = rng.integers(3)
+        center = [rng.integers(n) for n in shape]
+        sl = [slice(max(c-1,0), c+2) for c in center]
+        sl[axis] = slice(None)
+        vessels[tuple(sl)] = True
+    kind = np.where(rng.random(shape)<0.5, Labels['Artery'], Labels['Vein'])
+    kind = scipy.ndimage.median_filter(kind, 5)
+    volume[vessels] = kind[vessels]
+    return volume
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-size', type=int, nargs=3, default=[32, 160, 160], help="Volume size (z x y)")
+    parser.add_argument('-vessel_frac', type=float, default=0.1, help="Fraction of vessel voxels")
+    args = parser.parse_args()
+
+    volume = vessel_volume(tuple(args.size), args.vessel_frac)
+    print ('volume', volume.shape, 'vessel voxels', int(np.sum((volume==Labels['Artery'])|(volume==Labels['Vein']))))
+    for name, func in (('loop', RemoveLabelLoop), ('vectorized', RemoveLabel)):
+        v = volume.copy()
+        t0 = time.perf_counter()
+        for label in (Labels['Artery'], Labels['Vein']):
+            v = func(v, label)
+        elapsed = time.perf_counter()-t0
+        print ('{:>10}: {:.3f} s'.format(name, elapsed))
+        if name=='loop':
+            ref, t_loop = v, elapsed
+    assert np.array_equal(ref, v)
+    print ('identical output, speedup {:.1f}x'.format(t_loop/elapsed))
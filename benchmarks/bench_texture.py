@@ -0,0 +1,56 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from usct_vit import *
+
+'''
+Runtime and peak memory of one texture field on a 3D slab:
+sampler3D (float64 complex FFT) vs GaussTexture (float32 real FFT)
+'''
+
+def measure(func):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = func()
+    elapsed = time.perf_counter()-t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-size', type=int, nargs=3, default=[16, 512, 512], help="Slab size")
+    args = parser.parse_args()
+    shape = tuple(args.size)
+    kappa = 0.21; h = 0.1
+    nvox = float(np.prod(shape))
+
+    np.random.seed(0)
+    ref, t_ref, m_ref = measure(lambda: sampler3D(np.random.normal(0,1,shape), kappa, h))
+    GaussKernel.cache_clear()
+    np.random.seed(0)
+    new, t_new, m_new = measure(lambda: GaussTexture(WhiteNoise(shape, lambda s: np.random.normal(0,1,s)), kappa, h))
+    print ('slab', shape)
+    print ('  sampler3D:    {:.3f} s, peak {:.1f} bytes/voxel'.format(t_ref, m_ref/nvox))
+    print ('  GaussTexture: {:.3f} s, peak {:.1f} bytes/voxel'.format(t_new, m_new/nvox))
+    print ('  max abs difference {:.2e}, std {:.4f} vs {:.4f}'.format(np.abs(ref-new).max(), ref.std(), new.std()))
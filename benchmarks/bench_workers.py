@@ -0,0 +1,67 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from usct_vit import *
+
+'''
+Scaling of the property, resampling and texture stages with the number of threads
+the speedup is measured w.r.t. a single-thread run
+'''
+
+def run(volume, workers, tile):
+    np.random.seed(0)
+    times = []
+    t0 = time.perf_counter()
+    map_sos, map_density, map_atten = AssignProperties(volume, workers=workers)
+    times.append(time.perf_counter()-t0)
+    t0 = time.perf_counter()
+    map_sos, map_density, map_atten, label = ResampleMaps(map_sos, map_density, map_atten, volume, 0.5, workers)
+    times.append(time.perf_counter()-t0)
+    t0 = time.perf_counter()
+    AddTexture3D(map_sos, map_density, label, tile_shape=tile, seed=0, workers=workers)
+    times.append(time.perf_counter()-t0)
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-size', type=int, nargs=3, default=[64, 512, 512], help="Volume size (0.05 mm voxels)")
+    parser.add_argument('-workers', type=int, nargs='+', default=None, help="Thread counts to run (default: powers of 2 up to the number of cores)")
+    parser.add_argument('-texture_tile', type=int, default=0, help="Texture tile size (0: whole-volume FFT)")
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers is None:
+        workers = [2**i for i in range(int(np.log2(os.cpu_count()))+1)]
+    # the single-thread run is the reference of the speedup
+    workers = [1]+[w for w in workers if w!=1]
+    rng = np.random.default_rng(0)
+    volume = rng.choice(np.array([Labels['Water'], Labels['Fat'], Labels['Glandular'], Labels['Skin']], 'uint8'),
+                        size=tuple(args.size))
+    tile = args.texture_tile if args.texture_tile>0 else None
+    # warm up (imports, caches) outside of the timed runs
+    run(volume, 1, tile)
+    print ('{:>8} {:>10} {:>10} {:>10} {:>10} {:>8}'.format('workers', 'assign', 'resample', 'texture', 'total', 'speedup'))
+    for w in workers:
+        times = run(volume, w, tile)
+        if w==1:
+            ref = sum(times)
+        print ('{:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>8.2f}'.format(w, *(times+[sum(times), ref/sum(times)])))
@@ -0,0 +1,132 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import hdf5storage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from usct_vit import *
+from synthetic import SyntheticPhantom, WritePhantomFiles
+
+'''
+Time and peak memory of every pipeline stage on synthetic phantoms of
+several sizes, results are saved as json (one record per size and stage)
+
+python3 benchmarks/run_benchmarks.py -sizes 64x128x128 128x256x256 -output bench.json
+python3 benchmarks/run_benchmarks.py -sizes 64x128x128 -output new.json -compare bench.json
+'''
+
+def measure(records, size, stage, voxels, func, *args, **kwargs):
+    '''
+    run func(*args, **kwargs), append its wall/cpu time and peak traced
+    memory to records and return its output
+    '''
+    tracemalloc.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    out = func(*args, **kwargs)
+    cpu = time.process_time()-cpu
+    wall = time.perf_counter()-wall
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    records.append({'size': size, 'stage': stage, 'voxels': int(voxels),
+                    'wall_s': wall, 'cpu_s': cpu, 'peak_bytes': int(peak)})
+    print ('{:>14} {:<28} {:>9.3f} s {:>9.3f} s {:>10.1f} MB'.format(size, stage, wall, cpu, peak/2.**20))
+    return out
+
+
+def run_size(shape, vessel_frac, workdir, records):
+    size = 'x'.join(str(n) for n in shape)
+    nvox = np.prod(shape)
+    volume = SyntheticPhantom(shape, vessel_frac)
+    WritePhantomFiles(workdir, size, volume)
+    del volume
+    raw_path = workdir
+
+    measure(records, size, 'GetVolume(slab)', nvox, GetVolume, raw_path, size, shape[0]//2, 2, use_index=False)
+    volume = measure(records, size, 'GetVolume(full)', nvox, GetVolume, raw_path, size, -1, 0, use_index=False)
+    vessels = (volume==Labels['Artery'])|(volume==Labels['Vein'])
+    measure(records, size, 'RemoveLabel(Artery)', vessels.sum(), RemoveLabel, volume.copy(), Labels['Artery'])
+    del vessels
+    measure(records, size, 'Labelprocessing3d(nearest)', nvox, Labelprocessing3d, volume.copy(), 'nearest')
+    volume = measure(records, size, 'Labelprocessing3d(iterative)', nvox, Labelprocessing3d, volume, 'iterative')
+    nvox = volume.size
+
+    np.random.seed(0)
+    maps = measure(records, size, 'AssignProperties', nvox, AssignProperties, volume)
+    down = measure(records, size, 'ResampleMaps(zoom)', nvox, ResampleMaps, *(maps+(volume, 0.5)))
+    measure(records, size, 'BlockReduce', nvox, BlockReduce, volume, 2, tables=PropertyTables())
+    map_sos, map_density, map_atten, label = down
+    measure(records, size, 'AddTexture3D', label.size, AddTexture3D, map_sos, map_density, label)
+    measure(records, size, 'AddTexture3D(tiled)', label.size, AddTexture3D, map_sos.copy(), map_density.copy(),
+            label, tile_shape=64, seed=0)
+
+    def write_mat():
+        for name, data in (('sos', map_sos), ('aa', map_atten), ('dd', map_density), ('label', label)):
+            out_name = os.path.join(workdir, name+'.mat')
+            if os.path.exists(out_name):
+                os.remove(out_name)
+            hdf5storage.write({name: data}, filename=out_name, matlab_compatible=True)
+    measure(records, size, 'write(mat)', label.size, write_mat)
+    measure(records, size, 'write(container)', label.size, WritePhantom, os.path.join(workdir, 'phantom.mat'),
+            map_sos, map_density, map_atten, label)
+    measure(records, size, 'write(container,gzip)', label.size, WritePhantom, os.path.join(workdir, 'phantom.mat'),
+            map_sos, map_density, map_atten, label, 'gzip')
+
+
+def compare(records, reference):
+    ref = {(r['size'], r['stage']): r for r in reference}
+    print ('{:>14} {:<28} {:>10} {:>10}'.format('size', 'stage', 'wall', 'memory'))
+    for r in records:
+        old = ref.get((r['size'], r['stage']))
+        if old is None:
+            continue
+        print ('{:>14} {:<28} {:>9.2f}x {:>9.2f}x'.format(r['size'], r['stage'], r['wall_s']/max(old['wall_s'], 1e-9),
+                                                     r['peak_bytes']/float(max(old['peak_bytes'], 1))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sizes', type=str, nargs='+', default=['32x128x128', '64x256x256'],
+                        help="Phantom sizes zxXxY (0.05 mm voxels)")
+    parser.add_argument('-vessel_frac', type=float, default=0.02, help="Vessel fraction of the breast")
+    parser.add_argument('-output', type=str, default='bench_results.json', help="Output json file")
+    parser.add_argument('-compare', type=str, default=None, help="Previous results to compare with")
+    parser.add_argument('-workdir', type=str, default=None, help="Directory of the temporary phantom files")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    records = []
+    try:
+        for size in args.sizes:
+            shape = tuple(int(n) for n in size.split('x'))
+            run_size(shape, args.vessel_frac, workdir, records)
+    finally:
+        shutil.rmtree(workdir)
+    with open(args.output, 'w') as fid:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                   'machine': platform.machine(), 'cpus': os.cpu_count(),
+                   'vessel_frac': args.vessel_frac, 'records': records}, fid, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as fid:
+            compare(records, json.load(fid)['records'])
@@ -0,0 +1,101 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import gzip
+import os
+import sys
+import numpy as np
+import scipy.ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from usct_vit.config import Labels
+
+'''
+Synthetic VICTRE-like label phantoms for benchmarks
+'''
+
+def SyntheticPhantom(shape, vessel_frac=0.02, gland_frac=0.4, muscle_slices=3, skin=2, seed=0):
+    '''
+    label volume (z, x, y) of a half-ellipsoid breast on the chest wall (z=0)
+    shape: volume size, z first as in GetVolume
+    vessel_frac: approximate fraction of the breast covered by Artery/Vein tubes
+    gland_frac: approximate glandular fraction of the breast interior
+    muscle_slices: number of slices of pectoral muscle at the chest wall
+    skin: skin thickness (voxels)
+    '''
+    rng = np.random.default_rng(seed)
+    nz, nx, ny = shape
+    z, x, y = np.ogrid[:nz, :nx, :ny]
+    # normalized ellipsoid radius, the breast fills ~90% of the volume
+    r = np.sqrt(((z-muscle_slices)/(0.9*(nz-muscle_slices)))**2
+                + ((x-nx/2.)/(0.45*nx))**2 + ((y-ny/2.)/(0.45*ny))**2)
+    volume = np.full(shape, Labels['Water'], 'uint8')
+    breast = (r<1) & (z>=muscle_slices)
+    inner = scipy.ndimage.binary_erosion(breast, iterations=skin, border_value=1)
+    volume[breast] = Labels['Skin']
+
+    noise = scipy.ndimage.gaussian_filter(rng.standard_normal(shape).astype('float32'), 3)
+    threshold = np.quantile(noise[inner], 1-gland_frac) if inner.any() else 0
+    volume[inner] = np.where(noise[inner]>threshold, Labels['Glandular'], Labels['Fat'])
+    # small structures removed by Labelprocessing3d
+    for key, frac in (('TDLU', 0.002), ('Duct', 0.002), ('Ligament', 0.005)):
+        volume[inner & (rng.random(shape)<frac)] = Labels[key]
+    volume[0:max(muscle_slices, 1)] = Labels['Muscle']
+    nipple = breast & ~inner & (z>nz/2) & ((x-nx/2.)**2+(y-ny/2.)**2<9)
+    volume[nipple] = Labels['Nipple']
+
+    vessels = np.zeros(shape, bool)
+    target = vessel_frac*inner.sum()
+    while vessels[inner].sum()<target:
+        # a random tube along one of the axes
+        axis = rng.integers(3)
+        center = [rng.integers(n) for n in shape]
+        radius = int(rng.integers(1, 3))
+        sl = [slice(max(c-radius, 0), c+radius+1) for c in center]
+        sl[axis] = slice(None)
+        vessels[tuple(sl)] = True
+    vessels &= inner
+    kind = np.where(rng.random(shape)<0.5, Labels['Artery'], Labels['Vein']).astype('uint8')
+    volume[vessels] = scipy.ndimage.median_filter(kind, 5)[vessels]
+    return volume
+
+
+def WritePhantomFiles(path, phantom_id, volume, spacing=0.05, compressed=True):
+    '''
+    write p_<id>.mhd and p_<id>.raw.gz as produced by VICTRE
+    (or the uncompressed p_<id>.raw if compressed is False)
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    nz, nx, ny = volume.shape
+    with open(os.path.join(path, 'p_'+phantom_id+'.mhd'), 'w') as fid:
+        fid.write('ObjectType = Image\n')
+        fid.write('NDims = 3\n')
+        fid.write('BinaryData = True\n')
+        fid.write('BinaryDataByteOrderMSB = False\n')
+        fid.write('CompressedData = False\n')
+        fid.write('TransformMatrix = 1 0 0 0 1 0 0 0 1\n')
+        fid.write('Offset = 0 0 0\n')
+        fid.write('CenterOfRotation = 0 0 0\n')
+        fid.write('ElementSpacing = %g %g %g\n' % (spacing, spacing, spacing))
+        fid.write('DimSize = %d %d %d\n' % (nz, nx, ny))
+        fid.write('AnatomicalOrientation = ???\n')
+        fid.write('ElementType = MET_UCHAR\n')
+        fid.write('ElementDataFile = p_%s.raw\n' % phantom_id)
+    if not compressed:
+        with open(os.path.join(path, 'p_'+phantom_id+'.raw'), 'wb') as fid:
+            fid.write(volume.tobytes(order='F'))
+        return
+    with gzip.open(os.path.join(path, 'p_'+phantom_id+'.raw.gz'), 'wb', compresslevel=1) as fid:
+        fid.write(volume.tobytes(order='F'))
@@ -15,9 +15,6 @@
 import argparse
 import struct
 from usct_vit import *
-import h5py
-import hdf5storage
-import scipy
 
 '''
 This code assign acoustic properties to the NBP (2D slice, 3D slab, or full phantom)  
@@ -26,10 +23,10 @@ This code assign acoustic properties to the NBP (2D slice, 3D slab, or full phan
 def input_check():
     # check whether raw data file exist
     assert(os.path.exists(raw_data_path)) # The raw data file doesn't exist
-    rawgzFile = os.path.join(raw_data_path, 'p_'+phantom_id+'.raw.gz')
     headerFile = os.path.join(raw_data_path, 'p_'+phantom_id+'.mhd')
-    assert(os.path.isfile(rawgzFile)) #The raw data file doesn't exist
     assert(os.path.isfile(headerFile)) #The raw data file doesn't exist
+    rawFile = ReadMetaHeader(headerFile)['DataFile']
+    assert(os.path.isfile(rawFile)) #The raw data file doesn't exist
     newfolder = os.path.join(output_path,phantom_id)
     if not os.path.exists(newfolder): #creat folder for saving data
         print('create a new folder',newfolder)
@@ -44,79 +41,160 @@ if __name__ == '__main__':
     parser.add_argument('-thickness', type=float, default=0, help="Thickness (mm) of the slab")
     parser.add_argument('-output_path', type=str, help="Output path")
     parser.add_argument('-resolution', type=float, default=0.1, help="Voxel size (mm)")
+    parser.add_argument('-label_removal', type=str, default='iterative', choices=['iterative', 'nearest'],
+                        help="Artery/Vein removal: iterative 18-neighbor vote or one-pass nearest tissue fill")
+    parser.add_argument('-cleanup_workers', type=int, default=1,
+                        help="Number of processes of the iterative Artery/Vein removal (z-slabs, same output)")
+    parser.add_argument('-compare_removal', action='store_true',
+                        help="Run both removal methods and report the tissue fraction differences")
+    parser.add_argument('-cache_dir', type=str, default=None,
+                        help="Directory of the cleaned label volume cache (disabled if not set)")
+    parser.add_argument('-cache_size', type=float, default=50, help="Maximum size (GB) of the label cache")
+    parser.add_argument('-texture_tile', type=int, default=0,
+                        help="Generate the texture by tiles of this size (voxels) with a fixed memory budget (0: whole volume)")
+    parser.add_argument('-downsampling', type=str, default='zoom', choices=['zoom', 'block'],
+                        help="zoom: spline resampling, block: block mean / majority vote (integer factors only)")
+    parser.add_argument('-exponent_window', type=float, default=0,
+                        help="Window (mm) of the fat fraction of the attenuation exponent map (0: no map)")
+    parser.add_argument('-output_format', type=str, default='mat', choices=['mat', 'container'],
+                        help="mat: one file per map, container: all the maps in one chunked file")
+    parser.add_argument('-compression', type=str, default=None,
+                        help="Lossless compression of the container: gzip, gzip:<level> or lzf")
+    parser.add_argument('-workers', type=int, default=1, help="Number of threads of the property and texture stages")
+    parser.add_argument('-seed', type=int, default=None, help="Random seed")
+    parser.add_argument('-region_properties', action='store_true',
+                        help="Draw the properties of every connected region of a tissue instead of one value per tissue")
+    parser.add_argument('-auto_crop', type=float, default=None,
+                        help="Process only the bounding box of the non-water voxels plus this margin (mm), "
+                             "the texture filter halo is added")
+    parser.add_argument('-crop_output', type=str, default='pad', choices=['pad', 'crop'],
+                        help="With -auto_crop, pad: pad the maps with water to the whole phantom, "
+                             "crop: save the box with its offset")
+    parser.add_argument('-pyramid', type=float, nargs='+', default=None,
+                        help="Coarser voxel sizes (mm) resampled from the -resolution maps and saved to one container")
+    parser.add_argument('-realizations', type=int, default=1,
+                        help="Number of realizations of the properties and texture, saved to one container if >1")
+    parser.add_argument('-report', action='store_true',
+                        help="Save the time and peak memory of every stage to report_<id>_z<slice>.json")
+    parser.add_argument('-profile_dir', type=str, default=None,
+                        help="Profile every stage with cProfile and save the statistics in this directory")
+    parser.add_argument('-verbose', action='store_true', help="Print the label diagnostics (slower)")
 
 
     args = parser.parse_args()
     phantom_id = args.phantom_id
     raw_data_path = args.raw_data_path
-    target_slice = np.int(args.target_slice/0.05)
     output_path = args.output_path
     voxel_size  = args.resolution
-    thickness = np.int(args.thickness/0.1)
+    input_check(); #check the correctness of the path
+    # voxel size of the label data along z (0.05 mm for VICTRE phantoms)
+    dz = ReadMetaHeader(os.path.join(raw_data_path, 'p_'+phantom_id+'.mhd'))['ElementSpacing'][0]
+    target_slice = int(args.target_slice/dz) if args.target_slice>=0 else -1
+    thickness = int(args.thickness/(2*dz))
+    if args.seed is not None:
+        np.random.seed(args.seed)
 
     # -----------------------------------
     # 1. Read 3D phantom label data
     # -------------------------------------
     # Target slice and the thinkness
-    input_check(); #check the correctness of the path
-    volume = GetVolume(raw_data_path, phantom_id, target_slice, thickness)
+    report = None
+    if args.report or args.profile_dir is not None:
+        report = RunReport(args.profile_dir, phantom_id=phantom_id, target_slice=target_slice,
+                           thickness=thickness, voxel_size=voxel_size, workers=args.workers)
     # -------------------------------
     # 2. Removel extral labels and extract the slice contain tumor
     # -------------------------------
-    #print (volume.shape)
-    volume = Labelprocessing3d(volume)
-    #print('v:',volume.shape)
-    if volume.shape[0]==1:
-        volume = np.squeeze(volume)
-    # overwrite the volume
-    #print('v:',volume.shape)
-    # -------------------------------
-    # 3. Assign acoustic properties
-    # -------------------------------
-    map_sos = np.zeros((volume.shape),'float32')
-    map_density = np.zeros((volume.shape),'float32')
-    map_atten = np.zeros((volume.shape),'float32')
-    for key in SOS:
-        print (key)
-        indices = np.where(volume==Labels[key])
-        map_sos[indices] = SetPropValue(SOS[key], key)
-        map_density[indices] = SetPropValue(Density[key], key)
-        map_atten[indices] = SetPropValue(Atten[key], key)
-    # -------------------------------
-    # 4. Downsampling (from 0.05mm to 0.1mm) (default)
-    # -------------------------------
-    downsampling_factor = 0.05/voxel_size
-    map_sos = scipy.ndimage.zoom(map_sos, downsampling_factor)
-    map_density = scipy.ndimage.zoom(map_density,downsampling_factor)
-    map_atten = scipy.ndimage.zoom(map_atten, downsampling_factor)
-    volume = scipy.ndimage.zoom(volume,downsampling_factor, mode='nearest')
-    map_sos, map_density = AddTexture3D(map_sos, map_density, volume)
-    map_sos = map_sos.astype('float32')
-    map_atten = map_atten.astype('float32')
-    map_density = map_density.astype('float32')
+    crop_info = {}
+    # cleaned labels are loaded from the cache when available
+    cache = None
+    if args.cache_dir is not None:
+        cache = LabelCache(args.cache_dir, int(args.cache_size*2**30))
+    crop_margin, crop_align = None, 1
+    if args.auto_crop is not None:
+        coarsest = max([voxel_size]+(args.pyramid or []))
+        crop_margin = CropMargin(voxel_size, args.auto_crop, dz)
+        crop_align = BlockFactor(dz/coarsest) or 1
+    volume = GetCleanVolume(raw_data_path, phantom_id, target_slice, thickness, args.label_removal, cache,
+                            report, args.verbose, crop_margin, crop_align, crop_info, args.cleanup_workers)
+    if args.compare_removal:
+        # same cache and crop box as the labels that are processed
+        other = 'nearest' if args.label_removal=='iterative' else 'iterative'
+        other_volume = GetCleanVolume(raw_data_path, phantom_id, target_slice, thickness, other, cache,
+                                      report, args.verbose, crop_margin, crop_align, {}, args.cleanup_workers)
+        print ('tissue fraction difference (%s - %s):' % (args.label_removal, other))
+        for key, diff in CompareLabelFractions(volume, other_volume).items():
+            print ('{:>12}: {:+.6f}'.format(key, diff))
+        del other_volume
+    newfolder = os.path.join(output_path,phantom_id)
+    attrs = {'phantom_id': phantom_id, 'target_slice': target_slice, 'voxel_size': voxel_size}
+    crop = None
+    if crop_info:
+        # offset of the box and whole shape in the output grid
+        crop = CropGrid(crop_info, volume.shape, voxel_size, args.downsampling, dz)
+        if args.realizations>1:
+            # the maps of the box are saved
+            attrs.update(crop_offset=crop[0], full_shape=crop[1])
+    assert(args.realizations==1 or args.pyramid is None) # ensemble or pyramid, not both
+    if args.realizations>1:
+        # -------------------------------
+        # 3.-5. Realizations of the properties and texture of the cleaned labels
+        # -------------------------------
+        seeds = [int(s.generate_state(1, np.uint64)[0])
+                 for s in np.random.SeedSequence(args.seed).spawn(args.realizations)]
+        out_name = os.path.join(newfolder, 'ensemble_'+phantom_id+'_z'+str(target_slice)+'.mat')
+        with PhantomWriter(out_name, args.compression, attrs=attrs) as writer:
+            volume = AcousticEnsemble(writer, volume, voxel_size, seeds, args.downsampling,
+                                      args.texture_tile if args.texture_tile>0 else None,
+                                      args.workers, report, dz, args.region_properties, crop_info or None)
+            if args.exponent_window>0:
+                with Stage(report, 'ExponentMap', voxels=volume.size):
+                    writer.Write('ay', ExponentMap(volume, voxel_size, args.exponent_window))
+        if report is not None:
+            report.Write(os.path.join(newfolder, 'report_'+phantom_id+'_z'+str(target_slice)+'.json'))
+    elif args.pyramid is not None:
+        # -------------------------------
+        # 3.-5. Textured maps at -resolution, then resampled to every coarser level
+        # -------------------------------
+        voxel_sizes = sorted(set([voxel_size]+args.pyramid))
+        assert(voxel_sizes[0]==voxel_size) # pyramid levels are coarser than -resolution
+        out_name = os.path.join(newfolder, 'pyramid_'+phantom_id+'_z'+str(target_slice)+'.mat')
+        with PhantomWriter(out_name, args.compression, attrs=dict(attrs, voxel_sizes=voxel_sizes)) as writer:
+            labels = AcousticPyramid(writer, volume, voxel_sizes, args.downsampling,
+                                     args.texture_tile if args.texture_tile>0 else None,
+                                     args.seed, args.workers, report, dz,
+                                     region_properties=args.region_properties, crop=crop_info or None)
+            if args.exponent_window>0:
+                for level_size, label in zip(voxel_sizes, labels):
+                    with Stage(report, 'ExponentMap', voxels=label.size, voxel_size=level_size):
+                        writer.Write(LevelName('ay', level_size), ExponentMap(label, level_size, args.exponent_window),
+                                     {'voxel_size': level_size})
+        if report is not None:
+            report.Write(os.path.join(newfolder, 'report_'+phantom_id+'_z'+str(target_slice)+'.json'))
+    else:
+        # -------------------------------
+        # 3. Assign acoustic properties
+        # 4. Downsampling (from 0.05mm to 0.1mm) (default)
+        # 5. Add texture
+        # -------------------------------
+        map_sos, map_density, map_atten, volume = AcousticMaps(volume, voxel_size, args.downsampling,
+                                                               args.texture_tile if args.texture_tile>0 else None,
+                                                               args.seed, args.workers, report, dz,
+                                                               region_properties=args.region_properties,
+                                                               crop=crop_info or None)
 
-    # ---------------------------------
-    # 7. save all the data
-    # ---------------------------------
+        map_exponent = None
+        if args.exponent_window>0:
+            with Stage(report, 'ExponentMap', voxels=volume.size):
+                map_exponent = ExponentMap(volume, voxel_size, args.exponent_window)
 
-    newfolder = os.path.join(output_path,phantom_id)
-    data = {'sos':map_sos}
-    out_name = os.path.join(newfolder,'sos_'+phantom_id+'_z'+str(target_slice)+'.mat')
-    if os.path.exists(out_name):
-        os.remove(out_name)
-    hdf5storage.write(data, filename=out_name, matlab_compatible=True)
-    data= {'aa': map_atten}
-    out_name = os.path.join(newfolder,'aa_'+phantom_id+'_z'+str(target_slice)+'.mat')
-    if os.path.exists(out_name):
-        os.remove(out_name)
-    hdf5storage.write(data, filename=out_name, matlab_compatible=True)
-    data = {'dd': map_density}
-    out_name = os.path.join(newfolder,'density_'+phantom_id+'_z'+str(target_slice)+'.mat')
-    if os.path.exists(out_name):
-       	os.remove(out_name)
-    hdf5storage.write(data, filename=out_name, matlab_compatible=True)
-    data = {'label': volume}
-    out_name = os.path.join(newfolder,'label_'+phantom_id+'_z'+str(target_slice)+'.mat')
-    if os.path.exists(out_name):
-       	os.remove(out_name)
-    hdf5storage.write(data, filename=out_name, matlab_compatible=True)
+        # ---------------------------------
+        # 7. save all the data
+        # ---------------------------------
+
+        with Stage(report, 'SaveMaps', voxels=volume.size, output_format=args.output_format):
+            SaveMaps(newfolder, phantom_id, 'z'+str(target_slice), map_sos, map_density, map_atten, volume,
+                     args.output_format, args.compression, attrs=attrs, map_exponent=map_exponent,
+                     crop=crop, pad=args.crop_output=='pad')
+        if report is not None:
+            report.Write(os.path.join(newfolder, 'report_'+phantom_id+'_z'+str(target_slice)+'.json'))
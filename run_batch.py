@@ -0,0 +1,62 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+from usct_vit import *
+
+'''
+This code assign acoustic properties to many slices/slabs of many phantoms
+listed in a manifest (see usct_vit/batch.py), every phantom is decoded and
+cleaned only once
+'''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-manifest', type=str, help="Batch manifest (json)")
+    parser.add_argument('-processes', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('-memory_limit', type=float, default=None, help="Peak memory budget (GB)")
+    parser.add_argument('-label_removal', type=str, default='iterative', choices=['iterative', 'nearest'],
+                        help="Artery/Vein removal: iterative 18-neighbor vote or one-pass nearest tissue fill")
+    parser.add_argument('-cache_dir', type=str, default=None,
+                        help="Directory of the cleaned label volume cache (disabled if not set)")
+    parser.add_argument('-cache_size', type=float, default=50, help="Maximum size (GB) of the label cache")
+    parser.add_argument('-texture_tile', type=int, default=0,
+                        help="Generate the texture by tiles of this size (voxels) with a fixed memory budget (0: whole volume)")
+    parser.add_argument('-downsampling', type=str, default='zoom', choices=['zoom', 'block'],
+                        help="zoom: spline resampling, block: block mean / majority vote (integer factors only)")
+    parser.add_argument('-output_format', type=str, default='mat', choices=['mat', 'container'],
+                        help="mat: one file per map, container: all the maps in one chunked file")
+    parser.add_argument('-compression', type=str, default=None,
+                        help="Lossless compression of the container: gzip, gzip:<level> or lzf")
+    parser.add_argument('-threads', type=int, default=1, help="Number of threads per worker process")
+    parser.add_argument('-cleanup_workers', type=int, default=1,
+                        help="Number of processes of the iterative Artery/Vein removal (z-slabs, same output)")
+    parser.add_argument('-seed', type=int, default=None, help="Base random seed")
+    parser.add_argument('-region_properties', action='store_true',
+                        help="Draw the properties of every connected region of a tissue instead of one value per tissue")
+    parser.add_argument('-report', action='store_true',
+                        help="Save the time and peak memory of every stage to <output_path>/<id>/report_<id>.json")
+    args = parser.parse_args()
+
+    raw_data_path, output_path, phantoms = ReadManifest(args.manifest)
+    cache = None
+    if args.cache_dir is not None:
+        cache = LabelCache(args.cache_dir, int(args.cache_size*2**30))
+    done = RunBatch(raw_data_path, output_path, phantoms, args.processes,
+                    int(args.memory_limit*2**30) if args.memory_limit is not None else None,
+                    args.label_removal, cache, args.downsampling,
+                    args.texture_tile if args.texture_tile>0 else None,
+                    args.output_format, args.compression, args.seed, args.threads, args.report,
+                    args.region_properties, args.cleanup_workers)
+    print ('processed', len(done), 'slices')
@@ -0,0 +1,65 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+import argparse
+import json
+from usct_vit import *
+
+'''
+This code runs a long-lived worker processing slice jobs from a queue
+directory or a Unix socket (see usct_vit/worker.py), the cleaned labels of
+the recently used phantoms stay in memory; with -submit, it submits jobs
+to a worker instead
+'''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-queue_dir', type=str, default=None, help="Queue directory of the job files (<name>.json)")
+    parser.add_argument('-socket', type=str, default=None, help="Unix socket receiving the jobs")
+    parser.add_argument('-submit', type=str, nargs='+', default=None,
+                        help="Submit these job files (json, one job or a list) to the queue instead of serving it")
+    parser.add_argument('-memory_limit', type=float, default=None, help="Memory budget (GB) of the resident label volumes")
+    parser.add_argument('-label_removal', type=str, default='iterative', choices=['iterative', 'nearest'],
+                        help="Artery/Vein removal: iterative 18-neighbor vote or one-pass nearest tissue fill")
+    parser.add_argument('-cache_dir', type=str, default=None,
+                        help="Directory of the cleaned label volume cache (disabled if not set)")
+    parser.add_argument('-cache_size', type=float, default=50, help="Maximum size (GB) of the label cache")
+    parser.add_argument('-threads', type=int, default=1, help="Number of threads of the property and texture stages")
+    parser.add_argument('-cleanup_workers', type=int, default=1,
+                        help="Number of processes of the iterative Artery/Vein removal (z-slabs, same output)")
+    parser.add_argument('-poll', type=float, default=1.0, help="Seconds between two scans of an empty queue directory")
+    parser.add_argument('-exit_when_empty', action='store_true', help="Stop once the queue directory is empty")
+    parser.add_argument('-log', type=str, default=None,
+                        help="Append the result of every job (queue wait, service time) to this file (json lines)")
+    args = parser.parse_args()
+    assert((args.queue_dir is None)!=(args.socket is None)) # one of -queue_dir or -socket
+
+    if args.submit is not None:
+        for filename in args.submit:
+            with open(filename) as fid:
+                jobs = json.load(fid)
+            for job in (jobs if isinstance(jobs, list) else [jobs]):
+                print (SubmitJob(args.queue_dir or args.socket, job))
+    else:
+        cache = None
+        if args.cache_dir is not None:
+            cache = LabelCache(args.cache_dir, int(args.cache_size*2**30))
+        worker = PhantomWorker(int(args.memory_limit*2**30) if args.memory_limit is not None else None,
+                               args.label_removal, cache, args.threads, cleanup_workers=args.cleanup_workers)
+        if args.queue_dir is not None:
+            if not os.path.exists(args.queue_dir):
+                os.makedirs(args.queue_dir)
+            ServeDirectory(worker, args.queue_dir, args.poll, args.exit_when_empty, args.log)
+        else:
+            ServeSocket(worker, args.socket, args.log)
@@ -1,3 +1,10 @@
 from .config import *
 from .power_est import *
 from .utils import *
+from .report import *
+from .cache import *
+from .container import *
+from .pipeline import *
+from .batch import *
+from .reader import *
+from .worker import *
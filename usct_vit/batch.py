@@ -0,0 +1,218 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Batch generation of many slices/slabs from a list of phantoms
+
+Every phantom is decoded and cleaned once (full volume), the cleaned
+labels are placed in shared memory and the slices are processed by a
+pool of worker processes.
+
+Manifest (json):
+{
+    "raw_data_path": "./data/Phantom_set",
+    "output_path": "./data/acoustic_phantom",
+    "phantoms": ["324402160", {"phantom_id": "324402161", "target_slices": [30]}],
+    "target_slices": [25, 30],     # mm, -1 for the full volume
+    "thicknesses": [0, 0.5],       # mm
+    "resolutions": [0.1, 0.2]      # mm
+}
+every phantom is processed for all the combinations of target_slices x
+thicknesses x resolutions, the entries of a phantom override the defaults.
+'''
+
+from .config import *
+from .cache import GetCleanVolume
+from .utils import ReadMetaHeader
+from .pipeline import AcousticMaps, SaveMaps
+from .report import RunReport, Stage
+import concurrent.futures
+import itertools
+import json
+import numpy as np
+import os
+from multiprocessing import shared_memory
+
+__all__ = ['ReadManifest', 'SlabFromCleaned', 'RunBatch']
+
+# rough peak memory (bytes per 0.05 mm label voxel) of the processing of a slice
+SLICE_BYTES_PER_VOXEL = 40
+
+
+def ReadManifest(filename):
+    '''
+    Read a batch manifest
+    Output: raw_data_path, output_path, list of (phantom_id, [(target_slice, thickness, resolution)])
+    in mm, target_slice -1 for the full volume
+    '''
+    with open(filename) as fid:
+        manifest = json.load(fid)
+    phantoms = []
+    for entry in manifest['phantoms']:
+        if not isinstance(entry, dict):
+            entry = {'phantom_id': str(entry)}
+        opts = dict(manifest, **entry)
+        slices = []
+        for zz, th, res in itertools.product(opts.get('target_slices', [-1]), opts.get('thicknesses', [0]),
+                                             opts.get('resolutions', [0.1])):
+            slices.append((float(zz) if zz>=0 else -1, float(th), float(res)))
+        phantoms.append((str(opts['phantom_id']), slices))
+    return manifest['raw_data_path'], manifest['output_path'], phantoms
+
+
+def SlabFromCleaned(cleaned, zz, thickness):
+    '''
+    Slab of the cleaned full volume matching GetVolume(zz, thickness) followed by
+    Labelprocessing3d (the labels are cleaned in the full volume, so vessels
+    at the slab borders may be replaced differently)
+    cleaned: output of Labelprocessing3d on the full (cropped) volume, which
+             drops its first and last slices
+    '''
+    if zz==-1:
+        return cleaned
+    zDim = cleaned.shape[0]+2
+    assert(zz>=0 and zz<zDim) # need a reasonable target slice number
+    lb = zz-thickness;
+    ub = zz+thickness;
+    assert(lb>=0) # out of the bounds
+    assert(ub<zDim) # out of the bounds
+    lb = max(lb-1, 0);
+    ub = min(ub+1, zDim-1)
+    # cleaned[j] is the slice j+1 of the cropped volume
+    return cleaned[lb:ub-1]
+
+
+def _SliceJob(job):
+    '''
+    process one slice in a worker process, the cleaned labels are read
+    from the shared memory block job['shm']
+    '''
+    shm = shared_memory.SharedMemory(name=job['shm'])
+    try:
+        cleaned = np.ndarray(job['shape'], 'uint8', buffer=shm.buf)
+        volume = np.array(SlabFromCleaned(cleaned, job['zz'], job['thickness']))
+        del cleaned
+    finally:
+        shm.close()
+    return _ProcessSlice(volume, job)
+
+
+def _ProcessSlice(volume, job):
+    '''
+    properties, resampling, texture and output of the cleaned slab volume
+    Output: tag, stage records (empty without job['report'])
+    '''
+    np.random.seed(job['seed'])
+    report = RunReport() if job['report'] else None
+    maps = AcousticMaps(volume, job['resolution'], job['downsampling'], job['texture_tile'],
+                        job['seed'], job['threads'], report, job['input_voxel_size'],
+                        region_properties=job['region_properties'])
+    newfolder = os.path.join(job['output_path'], job['phantom_id'])
+    with Stage(report, 'SaveMaps', voxels=maps[-1].size, output_format=job['output_format']):
+        SaveMaps(newfolder, job['phantom_id'], job['tag'], *maps, output_format=job['output_format'],
+                 compression=job['compression'],
+                 attrs={'phantom_id': job['phantom_id'], 'target_slice': job['zz'],
+                        'voxel_size': job['resolution']})
+    if report is not None:
+        for record in report.stages:
+            record['slice'] = job['tag']
+        return job['tag'], report.stages
+    return job['tag'], []
+
+
+def RunBatch(raw_data_path, output_path, phantoms, processes=1, memory_limit=None, label_removal='iterative',
+             cache=None, downsampling='zoom', texture_tile=None, output_format='mat', compression=None,
+             seed=None, threads=1, report=False, region_properties=False, cleanup_workers=1):
+    '''
+    Process the slices of every phantom (see ReadManifest)
+    processes: number of worker processes
+    memory_limit: bytes, a phantom is decoded only once the label volumes in
+                  use, the new one (counted twice while it is decoded and
+                  copied to shared memory) and the running slices fit in it
+    cache: optional LabelCache of the cleaned full volumes
+    seed: base seed, every slice gets its own seed derived from it
+    threads: threads per worker (see AcousticMaps)
+    cleanup_workers: processes of the vessel removal of every phantom (see Labelprocessing3d)
+    report: save the time and peak memory of every stage (cleaning in the
+            main process, slices in the workers) to <output_path>/<id>/report_<id>.json
+    other options as in run_assign_properties.py
+    Output: list of the output tags of the processed slices
+    '''
+    seeds = iter(np.random.SeedSequence(seed).spawn(sum(len(slices) for _, slices in phantoms)))
+    done = []
+    active = [] # (shared memory, bytes, futures, report) of the phantoms being processed
+
+    def release(entry):
+        shm, nbytes, futures, run_report = entry
+        try:
+            for future in futures:
+                tag, stages = future.result()
+                done.append(tag)
+                if run_report is not None:
+                    run_report.stages.extend(stages)
+        finally:
+            shm.close()
+            shm.unlink()
+        if run_report is not None:
+            phantom_id = run_report.info['phantom_id']
+            run_report.Write(os.path.join(output_path, phantom_id, 'report_'+phantom_id+'.json'))
+
+    def submit(pool, phantom_id, slices):
+        header = ReadMetaHeader(os.path.join(raw_data_path, 'p_'+phantom_id+'.mhd'))
+        shape = header['DimSize']
+        dz = header['ElementSpacing'][0]
+        # target slice and half thickness in voxels, as in run_assign_properties.py
+        slices = [(int(zz/dz) if zz>=0 else -1, int(th/(2*dz)), res) for zz, th, res in slices]
+        nbytes = int(np.prod(shape))
+        slice_bytes = processes*SLICE_BYTES_PER_VOXEL*max(
+            nbytes//shape[0]*(shape[0] if zz==-1 else 2*th+3) for zz, th, _ in slices)
+        if memory_limit is not None:
+            while active and sum(e[1] for e in active)+2*nbytes+slice_bytes>memory_limit:
+                release(active.pop(0))
+            if 2*nbytes+slice_bytes>memory_limit:
+                print ('phantom', phantom_id, 'alone exceeds the memory limit')
+        if not os.path.exists(os.path.join(output_path, phantom_id)):
+            os.makedirs(os.path.join(output_path, phantom_id))
+
+        run_report = RunReport(phantom_id=phantom_id, processes=processes, threads=threads) if report else None
+        cleaned = GetCleanVolume(raw_data_path, phantom_id, -1, 0, label_removal, cache, run_report,
+                                 cleanup_workers=cleanup_workers)
+        shm = shared_memory.SharedMemory(create=True, size=max(cleaned.nbytes, 1))
+        active.append((shm, cleaned.nbytes, [], run_report))
+        np.ndarray(cleaned.shape, 'uint8', buffer=shm.buf)[...] = cleaned
+        shape = cleaned.shape
+        del cleaned
+
+        for zz, th, res in slices:
+            tag = 'z'+str(zz)+'_t'+str(th)+'_r'+str(res)
+            job = {'shm': shm.name, 'shape': shape, 'phantom_id': phantom_id,
+                   'zz': zz, 'thickness': th, 'resolution': res, 'tag': tag,
+                   'seed': int(next(seeds).generate_state(1)[0]),
+                   'output_path': output_path, 'downsampling': downsampling,
+                   'texture_tile': texture_tile, 'output_format': output_format,
+                   'compression': compression, 'threads': threads, 'report': report,
+                   'input_voxel_size': dz, 'region_properties': region_properties}
+            active[-1][2].append(pool.submit(_SliceJob, job))
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        try:
+            for phantom_id, slices in phantoms:
+                submit(pool, phantom_id, slices)
+            while active:
+                release(active.pop(0))
+        finally:
+            for shm, _, _, _ in active:
+                shm.close()
+                shm.unlink()
+    return done
@@ -0,0 +1,198 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+On-disk cache of cleaned label volumes (output of Labelprocessing3d)
+'''
+
+from .config import *
+from .utils import CropBox, GetVolume, Labelprocessing3d, ReadMetaHeader
+from .report import Stage
+import hashlib
+import json
+import numpy as np
+import os
+
+__all__ = ['LabelCache', 'GetCleanVolume']
+
+# upper bound of the size of the header of a .npy file
+NPY_HEADER_BYTES = 4096
+
+# bump when the label processing changes its output
+CACHE_VERSION = 1
+
+
+class LabelCache(object):
+    '''
+    Content-addressed cache of cleaned label volumes
+    Entries are stored as uncompressed .npy files and loaded by mmap.
+    The key hashes the raw data file, the Labels table and the
+    extraction/removal settings. When the cache grows beyond max_bytes,
+    the least recently used entries are evicted.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=50*2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def RawDigest(self, rawFile, chunk_bytes=1<<24):
+        '''
+        sha256 of the raw data file
+        digests are memoized by (path, size, mtime) to avoid rehashing
+        '''
+        memoFile = os.path.join(self.cache_dir, 'raw_digests.json')
+        memo = {}
+        if os.path.isfile(memoFile):
+            with open(memoFile) as fid:
+                memo = json.load(fid)
+        path = os.path.abspath(rawFile)
+        stat = os.stat(path)
+        entry = memo.get(path)
+        if entry is not None and entry['size']==stat.st_size and entry['mtime_ns']==stat.st_mtime_ns:
+            return entry['sha256']
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(chunk_bytes), b''):
+                sha.update(chunk)
+        memo[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
+        self._AtomicWrite(memoFile, lambda fid: fid.write(json.dumps(memo).encode()))
+        return memo[path]['sha256']
+
+    def Key(self, rawFile, **settings):
+        '''
+        cache key of the cleaned volume of rawFile processed with settings
+        '''
+        desc = {'version': CACHE_VERSION,
+                'raw': self.RawDigest(rawFile),
+                'labels': Labels,
+                'settings': settings}
+        return hashlib.sha256(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+    def _Entry(self, key):
+        return os.path.join(self.cache_dir, key+'.npy')
+
+    def Get(self, key):
+        '''
+        memory-mapped (copy-on-write) cached volume, None on a miss
+        '''
+        entry = self._Entry(key)
+        if not os.path.isfile(entry):
+            return None
+        os.utime(entry, None) # mark as recently used
+        return np.load(entry, mmap_mode='c')
+
+    def Info(self, key):
+        '''
+        dict stored with the volume of key (see Put), None if there is none
+        '''
+        infoFile = os.path.join(self.cache_dir, key+'.json')
+        if not os.path.isfile(infoFile):
+            return None
+        with open(infoFile) as fid:
+            return json.load(fid)
+
+    def Put(self, key, volume, info=None):
+        '''
+        store volume (and the json serializable dict info), then evict the
+        least recently used entries
+        a volume larger than the cache is not stored (it would be evicted at once)
+        '''
+        if volume.nbytes+NPY_HEADER_BYTES>self.max_bytes:
+            print ('the label volume (%.2f GB) exceeds the cache size, not cached' % (volume.nbytes/2**30))
+            return
+        if info is not None:
+            self._AtomicWrite(os.path.join(self.cache_dir, key+'.json'),
+                              lambda fid: fid.write(json.dumps(info).encode()))
+        self._AtomicWrite(self._Entry(key), lambda fid: np.save(fid, volume))
+        self.Evict()
+
+    def Evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total<=self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            infoFile = os.path.join(self.cache_dir, name[:-4]+'.json')
+            if os.path.isfile(infoFile):
+                os.remove(infoFile)
+            total -= size
+
+    def _AtomicWrite(self, filename, write):
+        tmp = filename+'.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as fid:
+            write(fid)
+        os.replace(tmp, filename)
+
+
+def GetCleanVolume(_path, phantom_id, zz, thickness, method='iterative', cache=None, report=None,
+                   verbose=False, crop_margin=None, crop_align=1, crop=None, cleanup_workers=1):
+    '''
+    GetVolume followed by Labelprocessing3d, served from cache (a LabelCache)
+    when the same phantom was already processed with the same settings
+    report: optional RunReport, receives the stages 'cache', 'GetVolume',
+            'CropBox' and 'Labelprocessing3d'
+    verbose: see Labelprocessing3d
+    crop_margin: if given, only the bounding box of the non-water voxels
+                 plus crop_margin voxels (see CropBox, at least 1 so that
+                 the vessel removal sees the same neighbors) is processed
+    crop_align: the box starts at multiples of crop_align
+    crop: optional dict, receives the position of the box in the output
+          of Labelprocessing3d of the whole volume ('offset') and the
+          shape of that output ('shape')
+    cleanup_workers: processes of the vessel removal (see Labelprocessing3d)
+    '''
+    if crop is None:
+        crop = {}
+    if cache is not None:
+        rawFile = ReadMetaHeader(os.path.join(_path, 'p_'+phantom_id+'.mhd'))['DataFile']
+        settings = {'zz': zz, 'thickness': thickness, 'method': method}
+        if crop_margin is not None:
+            settings.update(crop_margin=crop_margin, crop_align=crop_align)
+        with Stage(report, 'cache') as record:
+            key = cache.Key(rawFile, **settings)
+            volume = cache.Get(key)
+            record['hit'] = volume is not None
+        if volume is not None:
+            print ('load the cleaned label volume from cache', key)
+            crop.update(cache.Info(key) or {})
+            return volume
+    with Stage(report, 'GetVolume') as record:
+        volume = GetVolume(_path, phantom_id, zz, thickness)
+        record['voxels'] = volume.size
+    info = None
+    if crop_margin is not None:
+        assert(crop_margin>=1) # the vessel removal needs a water border
+        with Stage(report, 'CropBox', voxels=volume.size) as record:
+            # a slab keeps all its slices
+            margin = [crop_margin if zz==-1 else volume.shape[0]]+[crop_margin]*(volume.ndim-1)
+            box = CropBox(volume, margin, crop_align)
+            # Labelprocessing3d drops the first and last slices of both volumes
+            info = {'offset': [s.start for s in box], 'shape': [volume.shape[0]-2]+list(volume.shape[1:])}
+            volume = np.array(volume[box], order='F')
+            record['box'] = [[s.start, s.stop] for s in box]
+        crop.update(info)
+        print ('crop to the non-water bounding box', volume.shape)
+    with Stage(report, 'Labelprocessing3d', voxels=volume.size, method=method, workers=cleanup_workers) as record:
+        volume = Labelprocessing3d(volume, method, stats=record, verbose=verbose, workers=cleanup_workers)
+    if cache is not None:
+        cache.Put(key, volume, info)
+    return volume
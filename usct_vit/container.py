@@ -0,0 +1,189 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Single-file output of the phantom maps (MATLAB v7.3 / HDF5)
+'''
+
+from .lazy import LazyModule
+import datetime
+import numpy as np
+import os
+
+h5py = LazyModule('h5py')
+
+__all__ = ['PhantomWriter', 'WritePhantom']
+
+# MATLAB class of the numpy types written to the container
+MATLAB_CLASS = {
+    np.dtype('float32'): 'single',
+    np.dtype('float64'): 'double',
+    np.dtype('uint8'):   'uint8',
+    np.dtype('uint16'):  'uint16',
+    np.dtype('int32'):   'int32',
+}
+
+
+def _MatlabHeader():
+    '''
+    128 first bytes of the userblock of a MATLAB v7.3 MAT-file
+    '''
+    now = datetime.datetime.now(datetime.timezone.utc)
+    weekday = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')[now.weekday()]
+    month = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')[now.month-1]
+    s = 'MATLAB 7.3 MAT-file, Platform: usct_vit, Created on: %s %s %s HDF5 schema 1.00 .' \
+        % (weekday, month, now.strftime('%d %H:%M:%S %Y'))
+    b = bytearray(s+(128-12-len(s))*' ', encoding='utf-8')
+    b.extend(bytearray.fromhex('00000000 00000000 0002494D'))
+    return bytes(b)
+
+
+class PhantomWriter(object):
+    '''
+    Writer of the phantom maps (sos, density, attenuation, label, ...)
+    into one HDF5 file readable by MATLAB (load/matfile, v7.3).
+    Like hdf5storage with matlab_compatible=True, arrays are stored
+    transposed, so MATLAB sees the numpy shape. Datasets are chunked along
+    the first (z) axis and may be written slab by slab as they are produced.
+
+    with PhantomWriter(filename, compression='gzip') as writer:
+        writer.Create('sos', shape, 'float32')
+        for z0, slab in slabs:
+            writer.WriteSlab('sos', z0, slab)
+        writer.Write('label', volume)
+    '''
+
+    def __init__(self, filename, compression=None, chunk_z=8, chunk_xy=256, attrs=None):
+        '''
+        filename: output file, overwritten if it exists
+        compression: None, 'gzip' (or 'gzip:<level>') or 'lzf', lossless
+        chunk_z: number of slices per chunk
+        chunk_xy: chunk size along the other axes
+        attrs: dict of attributes of the file (ignored by MATLAB)
+        '''
+        self.filename = filename
+        self.chunk_z = chunk_z
+        self.chunk_xy = chunk_xy
+        self.compression, self.compression_opts = None, None
+        if compression is not None:
+            name, _, level = compression.partition(':')
+            assert(name in ('gzip', 'lzf')) # unsupported compression
+            self.compression = name
+            self.compression_opts = int(level) if level else None
+        if os.path.exists(filename):
+            os.remove(filename)
+        h5py.File(filename, 'w', userblock_size=512).close()
+        with open(filename, 'r+b') as fid:
+            fid.write(_MatlabHeader())
+        self.file = h5py.File(filename, 'a')
+        for key, value in (attrs or {}).items():
+            self.file.attrs[key] = value
+
+    def Create(self, name, shape, dtype, attrs=None, chunks=None, fillvalue=None):
+        '''
+        create the dataset name of (numpy) shape and dtype
+        chunks: chunk shape (numpy order), by default chunk_z slices of
+                chunk_xy^2 voxels for a 3d dataset
+        fillvalue: value of the voxels that are never written, the chunks
+                   that are never written take no space in the file
+        '''
+        dtype = np.dtype(dtype)
+        h5shape = tuple(shape)[::-1]
+        if chunks is None:
+            chunks = self.Chunks(shape)
+        chunks = [min(c, n) for c, n in zip(tuple(chunks)[::-1], h5shape)]
+        dset = self.file.create_dataset(name, h5shape, dtype, chunks=tuple(chunks),
+                                        compression=self.compression,
+                                        compression_opts=self.compression_opts,
+                                        shuffle=self.compression is not None and dtype.itemsize>1,
+                                        fillvalue=fillvalue)
+        dset.attrs['MATLAB_class'] = np.bytes_(MATLAB_CLASS[dtype])
+        for key, value in (attrs or {}).items():
+            dset.attrs[key] = value
+        return dset
+
+    def Chunks(self, shape):
+        '''
+        default chunk shape (numpy order) of a dataset of shape
+        '''
+        chunks = [min(n, self.chunk_xy) for n in shape]
+        if len(shape)==3:
+            chunks[0] = min(shape[0], self.chunk_z)
+        return tuple(chunks)
+
+    def WriteSlab(self, name, z0, data):
+        '''
+        write data to the slices z0:z0+len(data) of the dataset name
+        (the first axis, e.g. the realization of a stacked dataset)
+        '''
+        dset = self.file[name]
+        data = np.asarray(data, dset.dtype)
+        dset[..., z0:z0+data.shape[0]] = data.T
+
+    def WriteBlock(self, name, offset, data):
+        '''
+        write data to the box of the dataset name starting at offset (numpy order)
+        the box is written by slabs of one chunk along the first axis, so
+        that the (transposed) copy h5py makes is one slab and not the box
+        '''
+        dset = self.file[name]
+        data = np.asarray(data, dset.dtype)
+        step = dset.chunks[-1]
+        for z in range(0, data.shape[0], step):
+            slab = data[z:z+step]
+            start = (offset[0]+z,)+tuple(offset[1:])
+            dset[tuple(slice(a, a+n) for a, n in zip(start, slab.shape))[::-1]] = slab.T
+
+    def Write(self, name, data, attrs=None):
+        '''
+        create the dataset name and write the whole array data (by slabs,
+        see WriteBlock)
+        '''
+        data = np.asarray(data)
+        self.Create(name, data.shape, data.dtype, attrs)
+        self.WriteBlock(name, (0,)*data.ndim, data)
+
+    def Close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+def WritePhantom(filename, map_sos, map_density, map_atten, label, compression=None, attrs=None,
+                 map_exponent=None, pad=None):
+    '''
+    write the sos, density (dd), attenuation (aa), label and, if given,
+    attenuation exponent (ay) maps to one file
+    pad: optional (offset, shape, fill values of the maps in the above
+         order), the maps are a box of a larger volume of this shape; the
+         voxels outside the box get the fill values without being written
+    '''
+    maps = [('sos', np.asarray(map_sos, 'float32')), ('dd', np.asarray(map_density, 'float32')),
+            ('aa', np.asarray(map_atten, 'float32')), ('label', np.asarray(label, 'uint8'))]
+    if map_exponent is not None:
+        maps.append(('ay', np.asarray(map_exponent, 'float32')))
+    with PhantomWriter(filename, compression, attrs=attrs) as writer:
+        for k, (name, data) in enumerate(maps):
+            if pad is None:
+                writer.Write(name, data)
+            else:
+                offset, shape, fill = pad
+                writer.Create(name, shape, data.dtype, fillvalue=fill[k])
+                writer.WriteBlock(name, offset, data)
@@ -0,0 +1,48 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Deferred imports of the heavy dependencies (scipy, h5py, hdf5storage), so
+that importing usct_vit only costs what a run actually uses
+'''
+
+import importlib
+import types
+
+__all__ = ['LazyModule']
+
+
+class LazyModule(types.ModuleType):
+    '''
+    Stand-in for a module, imported on the first access to one of its
+    attributes (submodules included, e.g. LazyModule('scipy').ndimage)
+
+    stats = LazyModule('scipy.stats')   # instead of import scipy.stats as stats
+    '''
+
+    def __getattr__(self, attr):
+        # only called for the attributes not yet copied from the module
+        module = importlib.import_module(self.__name__)
+        try:
+            value = getattr(module, attr)
+        except AttributeError:
+            try:
+                value = importlib.import_module(self.__name__+'.'+attr)
+            except ImportError:
+                raise AttributeError("module '%s' has no attribute '%s'" % (self.__name__, attr))
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self.__name__
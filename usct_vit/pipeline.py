@@ -0,0 +1,320 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Acoustic property assignment of cleaned label data and saving of the maps
+(the steps of run_assign_properties.py after the label processing)
+'''
+
+from .utils import *
+from .container import WritePhantom
+from .power_est import b_estimate_table
+from .report import Stage
+from .lazy import LazyModule
+import math
+import numpy as np
+import os
+
+hdf5storage = LazyModule('hdf5storage')
+scipy = LazyModule('scipy')
+
+__all__ = ['AcousticMaps', 'AcousticEnsemble', 'AcousticPyramid', 'LevelName', 'CropMargin', 'CropGrid',
+           'ExponentMap', 'SaveMaps']
+
+
+def CropMargin(voxel_size, margin=0, input_voxel_size=0.05, kappa=0.21, h=0.1):
+    '''
+    Margin (voxels of the label data) of the crop box of GetCleanVolume:
+    margin (mm), plus the radius of the texture filter (see GaussTaps, in
+    output voxels) so that the periodic texture of AddTexture3D doesn't wrap
+    around the tissue, plus one voxel of water for the vessel removal
+    '''
+    halo = len(GaussTaps(kappa, h))//2*voxel_size
+    return int(math.ceil((margin+halo)/input_voxel_size-1e-9))+1
+
+
+def _SqueezeCrop(crop, volume_shape):
+    '''
+    crop (dict or tuple) as an (offset, shape) tuple, without the first
+    axis for a single slice (squeezed by AcousticMaps)
+    '''
+    if crop is None:
+        return None
+    if isinstance(crop, dict):
+        crop = (crop['offset'], crop['shape'])
+    if volume_shape[0]==1:
+        return tuple(crop[0][1:]), tuple(crop[1][1:])
+    return tuple(crop[0]), tuple(crop[1])
+
+
+def CropGrid(crop, volume_shape, voxel_size, downsampling='zoom', input_voxel_size=0.05):
+    '''
+    Position of the crop box in the output grid of AcousticMaps
+    Input:
+    crop: offset and shape of the crop box in the whole label data (dict
+          filled by GetCleanVolume, or tuple)
+    volume_shape: shape of the cropped label data
+    voxel_size, downsampling, input_voxel_size: see AcousticMaps
+    Output: offset of the box and shape of the whole volume in the output grid
+    '''
+    if isinstance(crop, dict):
+        crop = (crop['offset'], crop['shape'])
+    offset, shape = list(crop[0]), list(crop[1])
+    if len(volume_shape)==len(shape) and volume_shape[0]==1:
+        # single slices are squeezed by AcousticMaps
+        offset, shape, volume_shape = offset[1:], shape[1:], volume_shape[1:]
+    factor = input_voxel_size/voxel_size
+    block = BlockFactor(factor) if downsampling=='block' else None
+    if block is not None:
+        # the box starts at multiples of block (crop_align)
+        return [a//block for a in offset], [-(-n//block) for n in shape]
+    out_offset, _, out_whole, _ = ZoomBox(volume_shape, factor, (offset, shape))
+    return out_offset, out_whole
+
+
+def AcousticMaps(volume, voxel_size, downsampling='zoom', texture_tile=None, seed=None, workers=1,
+                 report=None, input_voxel_size=0.05, rng=None, region_properties=False, crop=None):
+    '''
+    Assign the acoustic properties, downsample and add the texture
+    Input:
+    volume: cleaned label data (output of Labelprocessing3d)
+    voxel_size: output voxel size (mm)
+    downsampling: 'zoom' or 'block' (see ResampleMaps)
+    texture_tile, seed: see AddTexture3D
+    workers: number of threads
+    report: optional RunReport, receives the stages 'BlockReduce' or
+            'AssignProperties' and 'ResampleMaps', and 'AddTexture3D'
+    input_voxel_size: voxel size (mm) of volume, 0.05 for VICTRE phantoms
+    rng: numpy Generator of the properties and texture, the global numpy
+         random state if None
+    region_properties: draw the properties of every connected region of
+                       a tissue (see RegionIndex) instead of one value per tissue
+    crop: if volume is a crop box of the label data (see GetCleanVolume),
+          its position, so that the maps are on the output grid of the
+          whole volume (see CropGrid)
+    Output: sos, density, attenuation (float32) and label maps
+    '''
+    crop = _SqueezeCrop(crop, volume.shape)
+    if volume.shape[0]==1:
+        volume = np.squeeze(volume)
+    downsampling_factor = input_voxel_size/voxel_size
+    block = BlockFactor(downsampling_factor)
+    if downsampling=='block' and block is not None and not region_properties:
+        # block means of the properties are computed from the label histograms
+        with Stage(report, 'BlockReduce', voxels=volume.size):
+            volume, map_sos, map_density, map_atten = BlockReduce(volume, block, tables=PropertyTables(rng),
+                                                                  workers=workers)
+    else:
+        if region_properties:
+            with Stage(report, 'RegionIndex', voxels=volume.size) as record:
+                index, regions = RegionIndex(volume)
+                record['regions'] = len(regions)
+            with Stage(report, 'AssignProperties', voxels=volume.size):
+                map_sos, map_density, map_atten = AssignProperties(index, tables=RegionTables(regions, rng),
+                                                                   workers=workers)
+            del index
+        else:
+            with Stage(report, 'AssignProperties', voxels=volume.size):
+                map_sos, map_density, map_atten = AssignProperties(volume, tables=PropertyTables(rng),
+                                                                   workers=workers)
+        with Stage(report, 'ResampleMaps', voxels=volume.size):
+            map_sos, map_density, map_atten, volume = ResampleMaps(map_sos, map_density, map_atten, volume,
+                                                                   downsampling_factor, workers, downsampling, crop)
+    with Stage(report, 'AddTexture3D', voxels=volume.size):
+        map_sos, map_density = AddTexture3D(map_sos, map_density, volume,
+                                            tile_shape=texture_tile, seed=seed, workers=workers, rng=rng)
+        map_sos = map_sos.astype('float32')
+        map_atten = map_atten.astype('float32')
+        map_density = map_density.astype('float32')
+    return map_sos, map_density, map_atten, volume
+
+
+def AcousticEnsemble(writer, volume, voxel_size, seeds, downsampling='zoom', texture_tile=None, workers=1,
+                     report=None, input_voxel_size=0.05, region_properties=False, crop=None):
+    '''
+    Realizations of the acoustic maps of one cleaned label volume
+    The labels are resampled once, and the property and texture buffers
+    are reused by every realization. Realization i is drawn from
+    np.random.default_rng(seeds[i]) and is the same as
+    AcousticMaps(..., seed=seeds[i], rng=np.random.default_rng(seeds[i])).
+    Input:
+    writer: PhantomWriter, receives the datasets label and sos, dd, aa
+            stacked along a first realization axis (one chunk per
+            realization), the seeds are saved in their attribute 'seeds'
+    volume, voxel_size, downsampling, texture_tile, workers, report,
+    input_voxel_size, region_properties, crop: see AcousticMaps, the
+    regions are labeled once
+    seeds: seed of every realization
+    Output: label map
+    '''
+    crop = _SqueezeCrop(crop, volume.shape)
+    if volume.shape[0]==1:
+        volume = np.squeeze(volume)
+    downsampling_factor = input_voxel_size/voxel_size
+    block = BlockFactor(downsampling_factor) if downsampling=='block' else None
+    with Stage(report, 'ResampleLabels', voxels=volume.size):
+        if block is not None:
+            label = BlockReduce(volume, block, workers=workers)[0]
+        else:
+            label = Zoom(volume, downsampling_factor, crop, mode='nearest')
+    if block is None or region_properties:
+        full = [np.empty(volume.shape, 'float32') for _ in range(3)]
+    maps = [np.empty(label.shape, 'float32') for _ in range(3)]
+    index = volume
+    if region_properties:
+        with Stage(report, 'RegionIndex', voxels=volume.size) as record:
+            index, regions = RegionIndex(volume)
+            record['regions'] = len(regions)
+
+    writer.Write('label', label)
+    names = ('sos', 'dd', 'aa')
+    attrs = {'seeds': np.array(seeds, 'uint64')}
+    for name in names:
+        writer.Create(name, (len(seeds),)+label.shape, 'float32', attrs, (1,)+writer.Chunks(label.shape))
+    for i, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        tables = RegionTables(regions, rng) if region_properties else PropertyTables(rng)
+        if block is not None and not region_properties:
+            with Stage(report, 'BlockReduce', voxels=volume.size, realization=i):
+                BlockReduce(volume, block, tables=tables, workers=workers, out=maps)
+        elif block is not None:
+            with Stage(report, 'AssignProperties', voxels=volume.size, realization=i):
+                AssignProperties(index, out=full, tables=tables, workers=workers)
+            with Stage(report, 'BlockReduce', voxels=volume.size, realization=i):
+                BlockReduce(volume, block, maps=full, workers=workers, out=maps)
+        else:
+            with Stage(report, 'AssignProperties', voxels=volume.size, realization=i):
+                AssignProperties(index, out=full, tables=tables, workers=workers)
+            with Stage(report, 'ResampleMaps', voxels=volume.size, realization=i):
+                Parallel(lambda k: Zoom(full[k], downsampling_factor, crop, output=maps[k]), range(3), workers)
+        with Stage(report, 'AddTexture3D', voxels=label.size, realization=i):
+            AddTexture3D(maps[0], maps[1], label, tile_shape=texture_tile, seed=seed, workers=workers, rng=rng)
+        with Stage(report, 'WriteRealization', voxels=label.size, realization=i):
+            for name, data in zip(names, maps):
+                writer.WriteSlab(name, i, data[None])
+    return label
+
+
+def LevelName(name, voxel_size):
+    '''
+    name of the dataset of a pyramid level, e.g. sos_200um
+    '''
+    return '%s_%dum' % (name, int(round(voxel_size*1000)))
+
+
+def AcousticPyramid(writer, volume, voxel_sizes, downsampling='zoom', texture_tile=None, seed=None, workers=1,
+                    report=None, input_voxel_size=0.05, rng=None, region_properties=False, crop=None):
+    '''
+    Acoustic maps at several voxel sizes, consistent across the levels
+    The textured maps are computed once at the finest voxel size (see
+    AcousticMaps), every coarser level is resampled from the previous one
+    (see ResampleMaps, 'block' averages the maps and takes the majority
+    label for integer ratios, e.g. 0.1, 0.2, 0.4 mm).
+    Input:
+    writer: PhantomWriter, receives the datasets sos, dd, aa and label of
+            every level, named by LevelName (e.g. sos_100um, label_400um),
+            with the attribute 'voxel_size' (and 'crop_offset', 'full_shape'
+            of the level with crop, see CropGrid)
+    voxel_sizes: output voxel sizes (mm)
+    other parameters: see AcousticMaps
+    Output: list of the label maps of the levels, finest first
+    '''
+    voxel_sizes = sorted(voxel_sizes)
+    volume_shape = volume.shape
+    maps = AcousticMaps(volume, voxel_sizes[0], downsampling, texture_tile, seed, workers, report,
+                        input_voxel_size, rng, region_properties, crop)
+    if crop is not None:
+        crop = CropGrid(crop, volume_shape, voxel_sizes[0], downsampling, input_voxel_size)
+    labels = []
+    for level, voxel_size in enumerate(voxel_sizes):
+        if level>0:
+            ratio = voxel_sizes[level-1]/voxel_size
+            with Stage(report, 'ResamplePyramid', voxels=maps[3].size, voxel_size=voxel_size):
+                shape = maps[3].shape
+                maps = ResampleMaps(*maps, ratio, workers, downsampling, crop)
+                if crop is not None:
+                    crop = CropGrid(crop, shape, voxel_size, downsampling, voxel_sizes[level-1])
+        attrs = {'voxel_size': voxel_size}
+        if crop is not None:
+            attrs.update(crop_offset=crop[0], full_shape=crop[1])
+        with Stage(report, 'WriteLevel', voxels=maps[3].size, voxel_size=voxel_size):
+            for name, data in zip(('sos', 'dd', 'aa', 'label'), maps):
+                writer.Write(LevelName(name, voxel_size), np.asarray(data, 'uint8' if name=='label' else 'float32'),
+                             attrs)
+        labels.append(maps[3])
+    return labels
+
+
+def ExponentMap(label, voxel_size, window, rd=0.5, table=None):
+    '''
+    Attenuation power-law exponent of every voxel, estimated (b_estimate)
+    from the fat fraction of the fat and glandular tissue in a box of
+    size window (mm) around it. Voxels without fat or glandular tissue in
+    their window get 0.
+    rd: radius of the 1d phantom of b_estimate
+    table: optional interpolation table (see b_estimate_table)
+    Output: float32 exponent map
+    '''
+    size = max(int(round(window/voxel_size)), 1)
+    fat = scipy.ndimage.uniform_filter((label==Labels['Fat']).astype('float32'), size)
+    tissue = scipy.ndimage.uniform_filter(np.isin(label, [Labels['Fat'], Labels['Glandular']]).astype('float32'), size)
+    if table is None:
+        table = b_estimate_table([rd])
+    valid = tissue>1e-6
+    exponent = np.zeros(label.shape, 'float32')
+    exponent[valid] = table(fat[valid]/tissue[valid], rd)
+    return exponent
+
+
+# value of the maps outside of the crop box
+WATER = {'sos': SOS['Water'], 'dd': Density['Water'], 'aa': Atten['Water'], 'label': Labels['Water'], 'ay': 0}
+
+
+def SaveMaps(newfolder, phantom_id, tag, map_sos, map_density, map_atten, volume,
+             output_format='mat', compression=None, attrs=None, map_exponent=None, crop=None, pad=True):
+    '''
+    Save the maps in newfolder
+    output_format: 'mat' one file per map (sos_, aa_, density_, label_<id>_<tag>.mat)
+                   'container' one file phantom_<id>_<tag>.mat (see WritePhantom)
+    map_exponent: optional attenuation exponent map (exponent_<id>_<tag>.mat, variable ay)
+    crop: optional (offset, shape) of the maps in the whole volume (see CropGrid)
+    pad: if True the maps are padded with water to the whole volume (in the
+         container, only the box is written), otherwise the box is saved
+         with its offset and the whole shape (file attributes of the
+         container, crop_<id>_<tag>.mat)
+    '''
+    attrs = dict(attrs or {})
+    if crop is not None and not pad:
+        attrs.update(crop_offset=crop[0], full_shape=crop[1])
+    if output_format=='container':
+        out_name = os.path.join(newfolder,'phantom_'+phantom_id+'_'+tag+'.mat')
+        fill = [WATER[name] for name in ('sos', 'dd', 'aa', 'label', 'ay')]
+        WritePhantom(out_name, map_sos, map_density, map_atten, volume, compression, attrs, map_exponent,
+                     pad=(crop[0], crop[1], fill) if crop is not None and pad else None)
+        return
+    maps = [('sos', 'sos', map_sos), ('aa', 'aa', map_atten),
+            ('density', 'dd', map_density), ('label', 'label', volume)]
+    if map_exponent is not None:
+        maps.append(('exponent', 'ay', map_exponent))
+    if crop is not None and not pad:
+        maps.append(('crop', 'crop', {'offset': np.array(crop[0]), 'shape': np.array(crop[1])}))
+    for prefix, name, data in maps:
+        if crop is not None and pad:
+            full = np.full(crop[1], WATER[name], data.dtype)
+            full[tuple(slice(a, a+n) for a, n in zip(crop[0], data.shape))] = data
+            data = full
+        out_name = os.path.join(newfolder,prefix+'_'+phantom_id+'_'+tag+'.mat')
+        if os.path.exists(out_name):
+            os.remove(out_name)
+        hdf5storage.write({name: data}, filename=out_name, matlab_compatible=True)
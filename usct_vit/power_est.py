@@ -72,3 +72,79 @@ def b_estimate(perc, rd=0.5):
     return 1.5
 
 #print b_estimate2(0.5)
+
+
+def _b_cost(b, m, rs, f_list):
+    '''
+    mismatch sum_f (exp(-f^b*m) - rs)^2 of b_estimate, for arrays b, m
+    of the same shape and rs of that shape + (len(f_list),)
+    '''
+    return np.sum(np.square(np.exp(-np.power(f_list, b[...,None])*m[...,None]) - rs), -1)
+
+
+def b_estimate_array(perc, rd=0.5, tol=1e-9, chunk=1<<16):
+    '''
+    vectorized b_estimate for arrays of fat percentages and radii
+    (broadcast together). The mismatch of b_estimate is minimized over
+    [1.08, 1.5]: the best point of a grid of step 0.01 brackets the
+    minimum, which is then refined by a golden-section search.
+    perc: the percentage of fat
+    rd: radius of phantom
+    tol: tolerance on b
+    '''
+    perc, rd = np.broadcast_arrays(np.asarray(perc, 'float64'), np.asarray(rd, 'float64'))
+    out = np.empty(perc.shape)
+    f_list = np.linspace(0.1,2.3,23)
+    y0_fat = 1.08;
+    y0_gland = 1.5;
+    a0_fat = 4.3578; #[Np/m/MHz]
+    a0_gland =8.635;
+    grid = np.linspace(y0_fat, y0_gland, 43)
+    step = grid[1]-grid[0]
+    invphi = (math.sqrt(5)-1)/2
+    alpha_fat = a0_fat*np.power(f_list, y0_fat)
+    alpha_gland = a0_gland*np.power(f_list, y0_gland)
+    p_flat, r_flat, o_flat = perc.ravel(), rd.ravel(), out.reshape(-1)
+    for s in range(0, p_flat.size, chunk):
+        p = p_flat[s:s+chunk]; r = r_flat[s:s+chunk]
+        rs = np.exp(-(r*p*2)[:,None]*alpha_fat - (r*(1-p)*2)[:,None]*alpha_gland)
+        m = r*2*(a0_fat*p+a0_gland*(1-p))
+        cost = np.stack([_b_cost(np.full(p.shape, b), m, rs, f_list) for b in grid], -1)
+        best = grid[np.argmin(cost, -1)]
+        lo = np.maximum(best-step, y0_fat)
+        hi = np.minimum(best+step, y0_gland)
+        c = hi-invphi*(hi-lo); d = lo+invphi*(hi-lo)
+        fc = _b_cost(c, m, rs, f_list); fd = _b_cost(d, m, rs, f_list)
+        for it in range(int(math.ceil(math.log(tol/(2*step))/math.log(invphi)))):
+            left = fc<fd
+            hi = np.where(left, d, hi); lo = np.where(left, lo, c)
+            c_new = hi-invphi*(hi-lo); d_new = lo+invphi*(hi-lo)
+            fc, fd = np.where(left, _b_cost(c_new, m, rs, f_list), fd), np.where(left, fc, _b_cost(d_new, m, rs, f_list))
+            c, d = np.where(left, c_new, d), np.where(left, c, d_new)
+        o_flat[s:s+chunk] = (lo+hi)/2
+    return out
+
+
+def b_estimate_table(rd_list, n_perc=1001):
+    '''
+    precompute b_estimate_array on a grid of n_perc fat percentages in
+    [0, 1] x rd_list (increasing) and return the function b(perc, rd)
+    interpolating it (bilinear, clamped to the grid)
+    '''
+    perc_grid = np.linspace(0, 1, n_perc)
+    rd_grid = np.atleast_1d(np.asarray(rd_list, 'float64'))
+    table = b_estimate_array(perc_grid[:,None], rd_grid[None,:])
+
+    def b_table(perc, rd=rd_grid[0]):
+        t = np.clip(np.asarray(perc, 'float64'), 0, 1)*(n_perc-1)
+        i = np.minimum(t.astype(int), n_perc-2); wi = t-i
+        if len(rd_grid)==1:
+            j, wj = np.zeros_like(i), 0.
+        else:
+            r = np.clip(np.asarray(rd, 'float64'), rd_grid[0], rd_grid[-1])
+            j = np.clip(np.searchsorted(rd_grid, r)-1, 0, len(rd_grid)-2)
+            wj = (r-rd_grid[j])/(rd_grid[j+1]-rd_grid[j])
+        j1 = np.minimum(j+1, len(rd_grid)-1)
+        return ((1-wi)*((1-wj)*table[i,j]+wj*table[i,j1])
+                + wi*((1-wj)*table[i+1,j]+wj*table[i+1,j1]))
+    return b_table
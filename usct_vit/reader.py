@@ -0,0 +1,385 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Lazy reading of regions of the saved phantom maps
+
+reader = OpenPhantom('./data/acoustic_phantom/324402160', '324402160', 'z-1')
+sos = reader['sos'].mm[10:20, 0:40, 30:50]    # mm, only the overlapping chunks are read
+label = reader['label'][100:200, :, 5]          # voxels
+'''
+
+from .lazy import LazyModule
+from .pipeline import LevelName, WATER
+import collections
+import itertools
+import os
+import threading
+import numpy as np
+
+h5py = LazyModule('h5py')
+hdf5storage = LazyModule('hdf5storage')
+
+__all__ = ['ChunkCache', 'LazyMap', 'PhantomReader', 'OpenPhantom']
+
+# other names of the maps
+ALIASES = {'density': 'dd', 'atten': 'aa', 'exponent': 'ay'}
+
+# chunk shape (voxels per axis) used to cache datasets that are not chunked
+DEFAULT_CHUNK = 64
+
+
+class ChunkCache(object):
+    '''
+    LRU cache of the chunks read from the phantom files, bounded in bytes
+    shared by all the maps of a reader (or of several readers)
+    '''
+
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def Get(self, key, read):
+        '''
+        chunk of key, read by read() on a miss
+        '''
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+                self.hits += 1
+                return chunk
+            self.misses += 1
+        chunk = read()
+        chunk.flags.writeable = False
+        with self._lock:
+            if key not in self._chunks and chunk.nbytes<=self.max_bytes:
+                self._chunks[key] = chunk
+                self.nbytes += chunk.nbytes
+                while self.nbytes>self.max_bytes:
+                    _, old = self._chunks.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return chunk
+
+    def Clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+
+
+def _Bounds(key, shape):
+    '''
+    (start, stop, step, keep axis) of every axis for a numpy basic index key
+    '''
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i]+(slice(None),)*(len(shape)-len(key)+1)+key[i+1:]
+    key = key+(slice(None),)*(len(shape)-len(key))
+    if len(key)!=len(shape):
+        raise IndexError('too many indices for a map of %d dimensions' % len(shape))
+    bounds = []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            if step<0:
+                raise IndexError('negative steps are not supported')
+            bounds.append((start, max(stop, start), step, True))
+        else:
+            i = int(k)
+            if i<0:
+                i += n
+            if not 0<=i<n:
+                raise IndexError('index %d is out of bounds for an axis of size %d' % (int(k), n))
+            bounds.append((i, i+1, 1, False))
+    return bounds
+
+
+class LazyMap(object):
+    '''
+    Array-like map of a phantom file, read chunk by chunk on indexing
+    map[...] takes voxel indices (integers, slices with positive steps)
+    map.mm[...] takes physical coordinates (mm) of the spatial axes: a
+    slice a:b selects the voxels whose center lies in [a, b), the voxels
+    outside the stored grid (e.g. the crop box) are set to fill; a number
+    selects the nearest voxel, which must be in the stored grid
+    '''
+
+    def __init__(self, dset, cache, voxel_size=None, origin=None, nspatial=None, fill=0):
+        '''
+        dset: h5py dataset, stored transposed as written by PhantomWriter
+              or hdf5storage (matlab_compatible)
+        cache: ChunkCache
+        voxel_size: voxel size (mm) of the spatial axes
+        origin: coordinates (mm) of the center of voxel 0 of the spatial axes
+        nspatial: number of spatial (last) axes, the leading axes (e.g.
+                  realizations) are indexed in voxels by map.mm
+        fill: value of the voxels outside the stored grid read by map.mm
+        '''
+        self.dset = dset
+        self.cache = cache
+        self.shape = tuple(dset.shape[::-1])
+        self.ndim = len(self.shape)
+        self.dtype = dset.dtype
+        self.nspatial = self.ndim if nspatial is None else nspatial
+        self.voxel_size = voxel_size
+        self.fill = fill
+        self.origin = np.zeros(self.nspatial) if origin is None else np.asarray(origin, float)
+        if dset.chunks is not None:
+            self.chunks = tuple(dset.chunks[::-1])
+        else:
+            self.chunks = tuple(min(n, DEFAULT_CHUNK) for n in self.shape)
+        self._key = (dset.file.filename, dset.name)
+
+    @property
+    def mm(self):
+        return _PhysicalIndexer(self)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def _ReadChunk(self, index):
+        box = tuple(slice(i*c, min((i+1)*c, n)) for i, c, n in zip(index, self.chunks, self.shape))
+        return np.ascontiguousarray(self.dset[box[::-1]].T)
+
+    def __getitem__(self, key):
+        bounds = _Bounds(key, self.shape)
+        out = np.empty([b-a for a, b, _, _ in bounds], self.dtype)
+        ranges = [range(a//c, -(-b//c)) for (a, b, _, _), c in zip(bounds, self.chunks)]
+        for index in itertools.product(*ranges):
+            chunk = self.cache.Get(self._key+(index,), lambda: self._ReadChunk(index))
+            src, dst = [], []
+            for i, c, (a, b, _, _) in zip(index, self.chunks, bounds):
+                lo, hi = max(a, i*c), min(b, (i+1)*c)
+                src.append(slice(lo-i*c, hi-i*c))
+                dst.append(slice(lo-a, hi-a))
+            out[tuple(dst)] = chunk[tuple(src)]
+        return out[tuple(slice(None, None, s) if keep else 0 for _, _, s, keep in bounds)]
+
+    def Index(self, key):
+        '''
+        voxel index of the physical (mm) index key, see LazyMap.mm
+        the slices of the spatial axes may extend past the stored grid
+        (start < 0 or stop > shape), an open bound is the edge of the grid
+        '''
+        if self.voxel_size is None:
+            raise ValueError('the voxel size of '+self.dset.name+' is unknown')
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key)>self.ndim:
+            raise IndexError('too many indices for a map of %d dimensions' % self.ndim)
+        nlead = self.ndim-self.nspatial
+        key = key+(slice(None),)*(self.ndim-len(key))
+        index = list(key[:nlead])
+        for k, origin, n in zip(key[nlead:], self.origin, self.shape[nlead:]):
+            if isinstance(k, slice):
+                if k.step is not None:
+                    raise IndexError('physical slices have no step')
+                a = 0 if k.start is None else int(np.ceil((k.start-origin)/self.voxel_size-1e-9))
+                b = n if k.stop is None else int(np.ceil((k.stop-origin)/self.voxel_size-1e-9))
+                index.append(slice(a, max(a, b)))
+            else:
+                i = int(np.round((k-origin)/self.voxel_size))
+                if not 0<=i<n:
+                    raise IndexError('coordinate %g mm is outside of the stored grid [%g, %g] mm'
+                                     % (k, origin, origin+(n-1)*self.voxel_size))
+                index.append(i)
+        return tuple(index)
+
+    def Read(self, index):
+        '''
+        map[index] for an index given by Index: the voxels of the spatial
+        slices outside the stored grid are set to fill, so that the output
+        has the requested shape
+        '''
+        nlead = self.ndim-self.nspatial
+        inner, dst, shape = [], [], []
+        for axis, k in enumerate(index):
+            n = self.shape[axis]
+            if axis<nlead and isinstance(k, slice):
+                inner.append(k)
+                dst.append(slice(None))
+                shape.append(len(range(*k.indices(n))))
+            elif isinstance(k, slice):
+                lo, hi = min(max(k.start, 0), n), min(max(k.stop, 0), n)
+                hi = max(hi, lo)
+                inner.append(slice(lo, hi))
+                start = lo-k.start if hi>lo else 0
+                dst.append(slice(start, start+hi-lo))
+                shape.append(k.stop-k.start)
+            else:
+                inner.append(k)
+        out = np.full(shape, self.fill, self.dtype)
+        out[tuple(dst)] = self[tuple(inner)]
+        return out
+
+    def Coordinates(self, axis):
+        '''
+        coordinates (mm) of the voxel centers along the spatial axis
+        '''
+        nlead = self.ndim-self.nspatial
+        return self.origin[axis-nlead]+self.voxel_size*np.arange(self.shape[axis])
+
+
+class _PhysicalIndexer(object):
+    def __init__(self, lazy):
+        self.lazy = lazy
+
+    def __getitem__(self, key):
+        return self.lazy.Read(self.lazy.Index(key))
+
+
+class PhantomReader(object):
+    '''
+    Lazy reader of the maps of a phantom, see OpenPhantom
+    reader[name] is a LazyMap, name one of the datasets (sos, dd, aa,
+    label, ay, sos_200um, ...) or density, atten, exponent; in a pyramid,
+    the bare names are the finest level, reader.Map(name, level) another one
+    '''
+
+    def __init__(self, files, voxel_size=None, origin=None, cache=None, cache_bytes=256*2**20):
+        '''
+        files: dict dataset name -> file name (container: several names in one file)
+        voxel_size: voxel size (mm), read from the files if they store it
+        origin: coordinates (mm) of the voxel 0, by default the crop offset
+                of the maps saved as a crop box (times voxel_size), else 0
+        cache: ChunkCache, by default a new one of cache_bytes
+        '''
+        self.cache = ChunkCache(cache_bytes) if cache is None else cache
+        self.files = {}
+        self.maps = {}
+        for name, filename in files.items():
+            if filename not in self.files:
+                self.files[filename] = h5py.File(filename, 'r')
+            fid = self.files[filename]
+            if name not in fid:
+                continue
+            dset = fid[name]
+            size = dset.attrs.get('voxel_size', fid.attrs.get('voxel_size', voxel_size))
+            offset = dset.attrs.get('crop_offset', fid.attrs.get('crop_offset'))
+            nspatial = len(offset) if offset is not None else None
+            if name in ('sos', 'dd', 'aa') and 'seeds' in dset.attrs:
+                # ensemble: realizations along the first axis
+                nspatial = len(dset.shape)-1
+            map_origin = origin
+            if map_origin is None and offset is not None and size is not None:
+                map_origin = np.asarray(offset)*float(size)
+            self.maps[name] = LazyMap(dset, self.cache, None if size is None else float(size),
+                                      map_origin, nspatial, WATER.get(name.split('_')[0], 0))
+
+    def _Resolve(self, name, level=None):
+        '''
+        dataset name of the map name (alias, or pyramid level of voxel size
+        level (mm), the finest by default)
+        '''
+        name = ALIASES.get(name, name)
+        if level is not None:
+            return LevelName(name, level)
+        if name in self.maps:
+            return name
+        levels = [(lazy.voxel_size, key) for key, lazy in self.maps.items()
+                  if key.rsplit('_', 1)[0]==name and key.endswith('um') and lazy.voxel_size is not None]
+        return min(levels)[1] if levels else name
+
+    def Map(self, name, level=None):
+        '''
+        LazyMap of name, level: voxel size (mm) of a pyramid level
+        '''
+        return self.maps[self._Resolve(name, level)]
+
+    def __getitem__(self, name):
+        return self.Map(name)
+
+    def __contains__(self, name):
+        return self._Resolve(name) in self.maps
+
+    def keys(self):
+        return self.maps.keys()
+
+    def Region(self, lo, hi, names=('sos', 'dd', 'aa', 'label'), level=None):
+        '''
+        maps of the box [lo, hi) (mm, one bound per spatial axis), the part
+        of the box outside the stored maps is water
+        level: voxel size (mm) of a pyramid level, the finest by default
+        Output: dict name -> array
+        '''
+        key = tuple(slice(a, b) for a, b in zip(lo, hi))
+        return {name: self.Map(name, level).mm[key] for name in names if self._Resolve(name, level) in self.maps}
+
+    def Close(self):
+        for fid in self.files.values():
+            fid.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+
+def OpenPhantom(folder, phantom_id, tag, voxel_size=None, cache=None, cache_bytes=256*2**20, kind=None):
+    '''
+    Open the maps saved by SaveMaps (or an ensemble/pyramid container) in
+    folder for phantom_id and tag (e.g. 'z-1'), without reading them
+    kind: 'phantom', 'ensemble' or 'pyramid' for the container
+          <kind>_<id>_<tag>.mat, 'maps' for the per-map files sos_,
+          density_, aa_, label_ (and exponent_) <id>_<tag>.mat, None for
+          the only kind found (ValueError if several were saved with tag)
+    voxel_size: voxel size (mm) of the per-map files, which don't store it
+    Output: PhantomReader
+    '''
+    assert(kind in (None, 'phantom', 'ensemble', 'pyramid', 'maps')) # unknown kind
+    found = {}
+    for prefix in ('phantom', 'ensemble', 'pyramid'):
+        filename = os.path.join(folder, prefix+'_'+phantom_id+'_'+tag+'.mat')
+        if os.path.isfile(filename):
+            found[prefix] = filename
+    files = {}
+    for prefix, name in (('sos', 'sos'), ('density', 'dd'), ('aa', 'aa'), ('label', 'label'), ('exponent', 'ay')):
+        filename = os.path.join(folder, prefix+'_'+phantom_id+'_'+tag+'.mat')
+        if os.path.isfile(filename):
+            files[name] = filename
+    if files:
+        found['maps'] = files
+    if kind is None:
+        if len(found)>1:
+            raise ValueError('several outputs for %s %s in %s (%s), choose one with kind'
+                             % (phantom_id, tag, folder, ', '.join(found)))
+        kind = next(iter(found), None)
+    if kind not in found:
+        raise IOError('no phantom maps%s for %s %s in %s' % (
+            ' ('+kind+')' if kind is not None else '', phantom_id, tag, folder))
+    if kind!='maps':
+        filename = found[kind]
+        with h5py.File(filename, 'r') as fid:
+            names = [name for name in fid if isinstance(fid[name], h5py.Dataset)]
+        return PhantomReader({name: filename for name in names}, voxel_size, cache=cache,
+                             cache_bytes=cache_bytes)
+    origin = None
+    cropFile = os.path.join(folder, 'crop_'+phantom_id+'_'+tag+'.mat')
+    if os.path.isfile(cropFile) and voxel_size is not None:
+        # maps saved as a crop box (SaveMaps with pad=False)
+        crop = hdf5storage.read('crop', filename=cropFile)
+        origin = np.ravel(crop['offset'])*voxel_size
+    return PhantomReader(files, voxel_size, origin, cache, cache_bytes)
@@ -0,0 +1,124 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Per-stage timing and memory instrumentation of a run
+'''
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import time
+
+__all__ = ['RunReport', 'Stage']
+
+
+def _ResetPeakRSS():
+    '''
+    reset the peak resident set size of the process (linux >= 4.0), return success
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fid:
+            fid.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _PeakRSS():
+    '''
+    peak resident set size (bytes) since the last reset, or of the process
+    '''
+    try:
+        with open('/proc/self/status') as fid:
+            for line in fid:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on linux, bytes on macOS
+    scale = 1 if os.uname().sysname=='Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+
+class RunReport(object):
+    '''
+    Records, for every stage of a run, the wall and CPU time, the peak
+    resident memory and stage specific counters, and saves them as json.
+
+    report = RunReport(phantom_id='324402160')
+    with report.Stage('Labelprocessing3d', voxels=volume.size) as record:
+        volume = Labelprocessing3d(volume, stats=record)
+    report.Write('report.json')
+    '''
+
+    def __init__(self, profile_dir=None, **info):
+        '''
+        profile_dir: if given, every stage is profiled with cProfile and its
+                     statistics saved to <profile_dir>/<stage>.prof
+        info: run description saved in the report
+        '''
+        self.info = dict(info)
+        self.stages = []
+        self.profile_dir = profile_dir
+        if profile_dir is not None and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def Stage(self, name, **counters):
+        '''
+        context measuring a stage, yields its record (a dict) to which the
+        stage can add counters
+        '''
+        record = {'stage': name}
+        record.update(counters)
+        peak_reset = _ResetPeakRSS()
+        profiler = None
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter()-wall
+            record['cpu_s'] = time.process_time()-cpu
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, '%02d_%s.prof' % (len(self.stages), name)))
+            record['peak_rss_bytes'] = _PeakRSS()
+            # without reset, the peak is the one of the process so far
+            record['peak_rss_per_stage'] = peak_reset
+            self.stages.append(record)
+
+    def Write(self, filename):
+        report = dict(self.info)
+        report['total_wall_s'] = time.perf_counter()-self.start
+        report['stages'] = self.stages
+        with open(filename, 'w') as fid:
+            json.dump(report, fid, indent=1, default=float)
+
+
+def Stage(report, name, **counters):
+    '''
+    report.Stage(name, **counters), or a context yielding a throwaway
+    record if report is None
+    '''
+    if report is None:
+        return contextlib.nullcontext(dict(counters))
+    return report.Stage(name, **counters)
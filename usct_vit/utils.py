@@ -13,65 +13,163 @@
 
 
 from .config import *
-import numpy.fft as fft
+from .lazy import LazyModule
 import math
-import scipy.stats as stats
+import functools
+import itertools
+import concurrent.futures
 import gzip
+import multiprocessing
+import threading
+import json
 import numpy as np
-import scipy.io as sio
 import os
-import h5py
-import hdf5storage
+from multiprocessing import shared_memory
 
+# imported on first use
+fft = LazyModule('numpy.fft')
+stats = LazyModule('scipy.stats')
+scipy = LazyModule('scipy')
+sio = LazyModule('scipy.io')
+h5py = LazyModule('h5py')
+hdf5storage = LazyModule('hdf5storage')
 
-def GetVolume(_path, phantom_id, zz, thickness ):
+
+# numpy type of the MetaImage element types
+MET_TYPES = {
+    'MET_CHAR': 'i1', 'MET_UCHAR': 'u1',
+    'MET_SHORT': 'i2', 'MET_USHORT': 'u2',
+    'MET_INT': 'i4', 'MET_UINT': 'u4',
+    'MET_LONG': 'i4', 'MET_ULONG': 'u4',
+    'MET_LONG_LONG': 'i8', 'MET_ULONG_LONG': 'u8',
+    'MET_FLOAT': 'f4', 'MET_DOUBLE': 'f8',
+}
+
+
+def ReadMetaHeader(headerFile):
+    '''
+    Parse a MetaImage (.mhd) header
+    Output: dict of the header fields (strings), plus
+    'DimSize': tuple of int, numpy order (VICTRE: z, x, y, z varies fastest)
+    'ElementSpacing': tuple of float (mm)
+    'dtype': numpy dtype of ElementType with the byte order of BinaryDataByteOrderMSB
+    'DataFile': path of the data file; VICTRE headers name p_<id>.raw, which
+                is read from p_<id>.raw.gz if only the compressed file exists
+    'DataOffset': offset (bytes) of the data in DataFile
+    'gzip': whether DataFile is gzip compressed
+    '''
+    header = {}
+    with open(headerFile, 'rb') as fid:
+        for line in fid:
+            key, sep, value = line.decode('latin-1').partition('=')
+            if not sep:
+                continue
+            header[key.strip()] = value.strip()
+            if key.strip()=='ElementDataFile':
+                # last field, a LOCAL data block follows it
+                local_offset = fid.tell()
+                break
+    for key in ('DimSize', 'ElementType', 'ElementDataFile'):
+        if key not in header:
+            raise ValueError('no %s in %s' % (key, headerFile))
+    header['DimSize'] = tuple(int(n) for n in header['DimSize'].split())
+    spacing = header.get('ElementSpacing', header.get('ElementSize', ' '.join(['1']*len(header['DimSize']))))
+    header['ElementSpacing'] = tuple(float(d) for d in spacing.split())
+    if header['ElementType'] not in MET_TYPES:
+        raise ValueError('unsupported ElementType %s in %s' % (header['ElementType'], headerFile))
+    msb = header.get('BinaryDataByteOrderMSB', header.get('ElementByteOrderMSB', 'False'))
+    header['dtype'] = np.dtype(MET_TYPES[header['ElementType']]).newbyteorder('>' if msb=='True' else '<')
+
+    if header['ElementDataFile']=='LOCAL':
+        dataFile = headerFile
+        offset = local_offset
+    else:
+        if header['ElementDataFile'].startswith('LIST') or '%' in header['ElementDataFile']:
+            raise ValueError('multi-file MetaImage data is not supported: '+headerFile)
+        dataFile = os.path.join(os.path.dirname(headerFile), header['ElementDataFile'])
+        if not os.path.isfile(dataFile) and os.path.isfile(dataFile+'.gz'):
+            dataFile = dataFile+'.gz'
+        offset = int(header.get('HeaderSize', 0))
+    header['DataFile'] = dataFile
+    header['gzip'] = dataFile.endswith('.gz')
+    if header.get('CompressedData', 'False')=='True' and not header['gzip']:
+        raise ValueError('zlib compressed MetaImage data is not supported: '+dataFile)
+    nbytes = int(np.prod(header['DimSize']))*header['dtype'].itemsize
+    if offset==-1:
+        # data at the end of the file
+        assert(not header['gzip']) # HeaderSize -1 of compressed data
+        offset = os.path.getsize(dataFile)-nbytes
+    header['DataOffset'] = offset
+    return header
+
+
+def OpenRaw(header):
+    '''
+    Read-only memory map of the uncompressed data of a MetaImage header
+    (see ReadMetaHeader), Fortran ordered so that its shape is DimSize
+    '''
+    assert(not header['gzip']) # compressed data can't be memory mapped
+    return np.memmap(header['DataFile'], header['dtype'], 'r', offset=header['DataOffset'],
+                     shape=header['DimSize'], order='F')
+
+
+def GetVolume(_path, phantom_id, zz, thickness, chunk_bytes=1<<26, use_index=True):
     '''
     read the raw data of fda phantom
     fdaphantom files description:
     *.mhd: the header file includes phantom size
-    p_*raw.gz: phantom label data without tumor
+    p_*raw.gz: phantom label data without tumor (or uncompressed p_*.raw)
+    p_*.index.json: (written by this function) muscle crop offset
     
     Input:
     _path: directory that contains raw phantom data
     phantim_id: the seed number of phantom data.
     zz: the target slice for extraction
     thickness: the thickness of 3d phantom
+    chunk_bytes: size of the chunks the raw data is decompressed by
+    use_index: read/write the sidecar index next to the header file
     Output: a (2*thickness+1) layers label phantom
+
+    The data file, element type and spacing are taken from the header.
+    Gzip data is decompressed chunk by chunk straight into the output
+    array, for a 2D slice or 3D slab only the requested z-range is kept.
+    Uncompressed data is memory mapped and only the requested z-range is
+    copied. The muscle slices are located by a first pass over the data
+    unless the sidecar index is available.
     '''
     headerFile = os.path.join(_path, 'p_'+phantom_id+'.mhd');
-    #rawFile = os.path.join(unzip_out, 'p_'+seed+'.raw');
-    rawgzFile = os.path.join(_path, 'p_'+phantom_id+'.raw.gz');
-    cmdout=os.popen('cat '+headerFile+' |grep DimSize').read()
-    cmdout=cmdout.split()
-    zDim = int(cmdout[2]);
-    xDim = int(cmdout[3]);
-    yDim = int(cmdout[4]);
+    header = ReadMetaHeader(headerFile)
+    zDim, xDim, yDim = header['DimSize']
+    dz, dx, dy = header['ElementSpacing']
+    rawFile = header['DataFile']
     #xDim =100
     print ("VICTRE dims: ", zDim,xDim,yDim)                                      
-    print ("physical dims: ",    '{:.4} {:.4} {:.4}'.format(zDim*0.05,xDim*0.05,yDim*0.05), 'mm')
-    fid = gzip.open(rawgzFile,'rb')
-    _buffer = fid.read(xDim*yDim*zDim)
-    fid.close()
-    volume = np.fromstring(_buffer, 'uint8')
-    volume = np.reshape(volume, (zDim, xDim, yDim), order='F')
-    print (volume.shape)
-    print ("Crop the phantom in z-direction to rule out muscle")
-    muscle_slices = [0]
-    for zidx in range(1,int(zDim)):
-        if Labels['Muscle'] in volume[zidx,:,:]:
-            muscle_slices.append(zidx)
-        else:
-            break
+    print ("physical dims: ",    '{:.4} {:.4} {:.4}'.format(zDim*dz,xDim*dx,yDim*dy), 'mm')
 
-    volume = np.delete(volume, range(max(muscle_slices)+1),0)
-    zDim = volume.shape[0]
+    index = ReadVolumeIndex(headerFile, rawFile, (zDim, xDim, yDim)) if use_index else None
+    volume = None
+    if zz==-1:
+        volume = np.empty((zDim, xDim, yDim), 'uint8', order='F')
+    print ("Crop the phantom in z-direction to rule out muscle")
+    if index is None or volume is not None:
+        slice_bits = np.zeros(zDim, 'uint16')
+        label_bits = _LabelBits()
+        for col, block in _Columns(header, chunk_bytes, volume):
+            if index is None:
+                slice_bits |= np.bitwise_or.reduce(label_bits[block], axis=0)
+        if index is None:
+            index = _MakeVolumeIndex(rawFile, (zDim, xDim, yDim), slice_bits)
+            if use_index:
+                WriteVolumeIndex(headerFile, index)
+    offset = index['crop_offset']
+    zDim = zDim-offset
     print ("the cropped VICTRE dims: ", zDim,xDim,yDim)
-    print ("the cropped physical dims: ", '{:.4} {:.4} {:.4}'.format(zDim*0.05,xDim*0.05,yDim*0.05), 'mm')
-    
+    print ("the cropped physical dims: ", '{:.4} {:.4} {:.4}'.format(zDim*dz,xDim*dx,yDim*dy), 'mm')
+
     #check target slice range
-    if zz==-1:
+    if volume is not None:
         print ('Generate whole 3d volume data')
-        return volume
+        return volume[offset:,:,:]
 
     print ('Generate 2D slice or 3D slab')
     assert(zz>=0 and zz<zDim) # need a reasonable target slice number
@@ -82,55 +180,309 @@ def GetVolume(_path, phantom_id, zz, thickness ):
     
     lb = max(lb-1, 0);
     ub = min(ub+1, zDim-1)
-    
-    return volume[lb:ub+1,:,:]
 
+    volume = np.empty((ub-lb+1, xDim, yDim), 'uint8', order='F')
+    if not header['gzip']:
+        volume[...] = OpenRaw(header)[offset+lb:offset+ub+1]
+        return volume
+    columns = volume.reshape(ub-lb+1, xDim*yDim, order='F')
+    for col, block in _Columns(header, chunk_bytes):
+        columns[:,col:col+len(block)] = block[:,offset+lb:offset+ub+1].T
+    return volume
+
+
+def _ReadInto(fid, out, chunk_bytes):
+    '''
+    Fill the 1d uint8 array out from the file object fid, chunk by chunk
+    '''
+    buf = memoryview(out)
+    pos = 0
+    while pos<len(buf):
+        n = fid.readinto(buf[pos:min(pos+chunk_bytes, len(buf))])
+        if n==0:
+            raise IOError('unexpected end of the phantom data (%d of %d bytes read)' % (pos, len(buf)))
+        pos += n
+
+
+def _StreamColumns(rawgzFile, zDim, ncols, chunk_bytes, out=None, dtype='uint8', offset=0):
+    '''
+    Decompress the Fortran-ordered label data by blocks of whole z-columns
+    yield (first column index, (ncolumns, zDim) block)
+    the block is a view of a reused buffer of about chunk_bytes bytes,
+    or of the flat (Fortran-ordered) output array out if given
+    dtype: element type of the data, offset: bytes skipped before the data
+    '''
+    dtype = np.dtype(dtype)
+    k = min(max(chunk_bytes//(zDim*dtype.itemsize), 1), ncols)
+    if out is None:
+        buf = np.empty(k*zDim, dtype)
+    else:
+        assert(out.dtype==dtype) # decompressed in place
+    with gzip.open(rawgzFile,'rb') as fid:
+        if offset:
+            fid.seek(offset)
+        col = 0
+        while col<ncols:
+            n = min(k, ncols-col)
+            block = buf[:n*zDim] if out is None else out[col*zDim:(col+n)*zDim]
+            _ReadInto(fid, block.view('uint8'), chunk_bytes)
+            yield col, block.reshape(n, zDim)
+            col += n
+
+
+def _Columns(header, chunk_bytes, out=None):
+    '''
+    Label data of a MetaImage header (see ReadMetaHeader) by blocks of whole
+    z-columns, as uint8, yield (first column index, (ncolumns, zDim) block)
+    out: optional (Fortran-ordered) uint8 array of shape DimSize, filled
+         with the data
+    '''
+    zDim = header['DimSize'][0]
+    ncols = int(np.prod(header['DimSize'][1:]))
+    flat = None if out is None else out.reshape(-1, order='F')
+    direct = header['dtype']==np.dtype('uint8') and header['gzip']
+    if header['gzip']:
+        blocks = _StreamColumns(header['DataFile'], zDim, ncols, chunk_bytes, flat if direct else None,
+                                header['dtype'], header['DataOffset'])
+    else:
+        data = OpenRaw(header).reshape(zDim, ncols, order='F')
+        k = min(max(chunk_bytes//(zDim*header['dtype'].itemsize), 1), ncols)
+        blocks = ((col, data[:,col:col+k].T) for col in range(0, ncols, k))
+    for col, block in blocks:
+        if block.dtype!=np.uint8:
+            block = block.astype('uint8')
+        if flat is not None and not direct:
+            flat[col*zDim:(col+len(block))*zDim] = block.ravel()
+        yield col, block
+
+
+def _LabelBits():
+    '''
+    Lookup table label value -> bit flag of the labels defined in config.py
+    '''
+    assert(len(Labels)<=16) # flags are stored as uint16
+    lut = np.zeros(256, 'uint16')
+    for bit, key in enumerate(Labels):
+        lut[Labels[key]] = 1<<bit
+    return lut
+
+
+def _MakeVolumeIndex(rawFile, shape, slice_bits):
+    '''
+    Build the sidecar index from the label flags of every z-slice
+    '''
+    has_muscle = (slice_bits & _LabelBits()[Labels['Muscle']])>0
+    # the first slice and the muscle slices that directly follow it are cropped
+    no_muscle = np.flatnonzero(~has_muscle[1:])
+    offset = int(no_muscle[0])+1 if len(no_muscle) else len(has_muscle)
+    stat = os.stat(rawFile)
+    return {'DimSize': [int(n) for n in shape],
+            'raw_size': stat.st_size,
+            'raw_mtime_ns': stat.st_mtime_ns,
+            'crop_offset': offset,
+            'labels': dict(Labels)}
+
+
+def _IndexFile(headerFile):
+    return os.path.splitext(headerFile)[0]+'.index.json'
+
+
+def ReadVolumeIndex(headerFile, rawFile, shape):
+    '''
+    Load the sidecar index of a phantom
+    Return None if it doesn't exist or doesn't match the raw data
+    '''
+    indexFile = _IndexFile(headerFile)
+    if not os.path.isfile(indexFile):
+        return None
+    with open(indexFile) as fid:
+        index = json.load(fid)
+    stat = os.stat(rawFile)
+    if index['DimSize']!=list(shape) or index['raw_size']!=stat.st_size \
+            or index['raw_mtime_ns']!=stat.st_mtime_ns \
+            or index.get('labels')!=dict(Labels):
+        return None
+    return index
+
+
+def WriteVolumeIndex(headerFile, index):
+    '''
+    Save the sidecar index next to the header file (skipped if not writable)
+    '''
+    try:
+        with open(_IndexFile(headerFile), 'w') as fid:
+            json.dump(index, fid)
+    except OSError as err:
+        print ('cannot write the phantom index:', err)
+
+
+def CropBox(volume, margin=0, align=1, background=Labels['Water']):
+    '''
+    Bounding box of the voxels that aren't background, plus a margin
+    Input:
+    volume: label data
+    margin: voxels added on both sides (an int or one per axis)
+    align: the box starts at multiples of align (an int or one per axis)
+    background: label of the voxels outside the box
+    Output: tuple of slices, the whole volume if all of it is background
+    '''
+    margin = np.broadcast_to(margin, (volume.ndim,))
+    align = np.broadcast_to(align, (volume.ndim,))
+    mask = volume!=background
+    box = []
+    for axis, n in enumerate(volume.shape):
+        occupied = np.flatnonzero(mask.any(axis=tuple(a for a in range(volume.ndim) if a!=axis)))
+        if len(occupied)==0:
+            return tuple(slice(0, n) for n in volume.shape)
+        a = max(int(occupied[0])-int(margin[axis]), 0)
+        a -= a%int(align[axis])
+        b = min(int(occupied[-1])+1+int(margin[axis]), n)
+        box.append(slice(a, b))
+    return tuple(box)
 
 
-def Labelprocessing3d(volume):
+def Labelprocessing3d(volume, method='iterative', stats=None, verbose=False, workers=1):
     '''
     Remove extra labels
     Input,
     volume: 3d label data
+    method: 'iterative' replaces Artery/Vein by the 18-neighbor vote of
+            RemoveLabel until no vessel voxel is left,
+            'nearest' fills all the vessel voxels at once by the nearest
+            remaining tissue (see FillLabelNearest)
+    stats: optional dict, receives the number of RemoveLabel/FillLabelNearest
+           passes ('removal_passes') and the Artery/Vein voxels left after
+           every iteration ('remaining_vessels')
+    verbose: print the labels left in the output (full scan of the volume)
+    workers: number of processes of the 'iterative' removal, which then runs
+             on z-slabs of the volume (same output, see RemoveVesselsParallel)
     
     Output: cleaned 3d label data
     '''
+    if stats is None:
+        stats = {}
     #keep the slice above and beblow the tumor slice for the next step
     volume[np.where(volume==Labels['TDLU'])] = Labels['Glandular']
     volume[np.where(volume==Labels['Duct'])] = Labels['Glandular']
     volume[np.where(volume==Labels['Nipple'])] = Labels['Skin']
+    if method=='nearest':
+        volume = FillLabelNearest(volume, [Labels['Artery'], Labels['Vein']])
+        stats['removal_passes'] = 1
+        stats['remaining_vessels'] = [[0, 0]]
+        if verbose:
+            print (np.unique(volume[1:-1,:,:]))
+        return volume[1:-1,:,:]
+    assert(method=='iterative') # unknown label removal method
+    if workers>1 and volume.shape[0]>3:
+        volume = RemoveVesselsParallel(volume, workers, stats, verbose)
+        if verbose:
+            print (np.unique(volume[1:-1,:,:]))
+        return volume[1:-1,:,:]
     #volume = RemoveLabel(volume, Labels['Ligament'])
     volume = RemoveLabel(volume, Labels['Artery'])
     volume = RemoveLabel(volume, Labels['Vein'])
-    # print np.unique(volume)
-    #check if extra labels are removed clearly
-    labelset = np.unique(volume)
-    itern = 0
+    passes = 2
+    remaining = []
     while 1:
         # until all extral labels are removed
         volume = RemoveLabel(volume, Labels['Artery'])
         volume = RemoveLabel(volume, Labels['Artery'])
         volume = RemoveLabel(volume, Labels['Vein'])
         volume = RemoveLabel(volume, Labels['Vein'])
+        passes += 4
         ar = np.sum(volume[1:-1,:,:]==Labels['Artery'])
         ve = np.sum(volume[1:-1,:,:]==Labels['Vein'])
-        #print (ar)
+        remaining.append([int(ar), int(ve)])
+        if verbose:
+            print ('removal pass', passes, 'artery', ar, 'vein', ve)
         if ar==0 and ve==0:
             break
-    print (np.unique(volume[1:-1,:,:]))
+    stats['removal_passes'] = passes
+    stats['remaining_vessels'] = remaining
+    if verbose:
+        print (np.unique(volume[1:-1,:,:]))
     #data={'v': volume}
     #hdf5storage.write(data, filename='v.mat', matlab_compatible=True)
     return volume[1:-1,:,:]
 
 
-def RemoveLabel(img, label):
+def FillLabelNearest(img, labels):
     '''
-    Replace the extra label by its neigbors
-    first, counting the labels frequency in adjacent 18 voxels
-    18 voxels include 5 voxels at above slice, 5 voxels at the below slice, 8 voxels at the current slice
-    then, replace the extra label by the highest frequency label
-    NOTICE: this method can't guarantee the extra label can be removed clearly
-    this function will be executed several times utils all extra labels are removed.  
+    Replace the extra labels by the label of the nearest voxel (Euclidean
+    distance) that carries none of them, in a single sweep.
+    Unlike RemoveLabel, thick vessels don't need to be peeled shell by shell.
+    Input:
+    img: 3d label data, modified in place
+    labels: list of the labels to remove
+    '''
+    mask = np.isin(img, labels)
+    if not mask.any() or mask.all():
+        return img
+    indices = scipy.ndimage.distance_transform_edt(mask, return_distances=False, return_indices=True)
+    img[mask] = img[tuple(idx[mask] for idx in indices)]
+    return img
+
+
+def LabelFractions(volume):
+    '''
+    Fraction of voxels of every label defined in config.py
+    '''
+    counts = np.bincount(volume.ravel(), minlength=256)
+    return {key: counts[Labels[key]]/float(volume.size) for key in Labels}
+
+
+def CompareLabelFractions(volume, reference):
+    '''
+    Difference of the tissue fractions of volume w.r.t. reference
+    e.g. the output of the 'nearest' and the 'iterative' Labelprocessing3d
+    Output: dict label -> fraction(volume) - fraction(reference)
+    '''
+    frac = LabelFractions(volume)
+    frac_ref = LabelFractions(reference)
+    return {key: frac[key]-frac_ref[key] for key in Labels}
+
+
+# offsets (dz, dx, dy) of the 18 neighbors used for the label vote,
+# listed in the order the neighbors are visited
+_NEIGHBORS_18 = (
+    # z = 0
+    (0, 1, 0), (0, -1, 0), (0, 0, -1), (0, 0, 1),
+    (0, 1, 1), (0, -1, 1), (0, 1, -1), (0, -1, -1),
+    # z = 1
+    (1, 0, 0), (1, 1, 0), (1, -1, 0), (1, 0, -1), (1, 0, 1),
+    # z = -1
+    (-1, 0, 0), (-1, 1, 0), (-1, -1, 0), (-1, 0, -1), (-1, 0, 1),
+)
+
+
+def _NeighborVote(img, ii, jj, kk, label):
+    '''
+    Vote the replacement label of voxel (ii,jj,kk) from its 18 neighbors
+    Return None if all neighbors carry the extra label
+    '''
+    z,x,y = img.shape
+    neighbor = [] #list for saving the labels frequency of neighbors
+    for dz,dx,dy in _NEIGHBORS_18:
+        j = jj+dx; k = kk+dy
+        if j<0 or j>=x or k<0 or k>=y:
+            continue
+        if img[ii+dz,j,k]!=label:
+            neighbor.append(img[ii+dz,j,k])
+    if len(neighbor)==0:
+        return None
+    newlabel = max(set(neighbor), key = neighbor.count) # get the highest frequency one
+    if newlabel==Labels['Vein'] or newlabel==Labels['Artery']:
+        if neighbor.count(Labels['Fat'])>neighbor.count(Labels['Glandular']):
+            newlabel = Labels['Fat']
+        else:
+            newlabel = Labels['Glandular']
+    return newlabel
+
+
+def RemoveLabelLoop(img, label):
+    '''
+    Reference (per-voxel) implementation of RemoveLabel
+    kept for validation and benchmarking of the vectorized version
     '''
     z,x,y = img.shape
     z_list,x_list,y_list=np.where(img==label)
@@ -141,58 +493,11 @@ def RemoveLabel(img, label):
         kk = y_list[idx]
         if ii==0 or ii==z-1:
             continue
-        # z = 0
-        neighbor = []#list for saving the labels frequency of neighbors 
-        if jj!=x and img[ii,jj+1,kk]!=label:
-            neighbor.append(img[ii,jj+1,kk])
-        if jj!=0 and img[ii,jj-1,kk]!=label:
-            neighbor.append(img[ii,jj-1,kk])
-        if kk!=0 and img[ii,jj,kk-1]!=label:
-            neighbor.append(img[ii,jj,kk-1])
-        if kk!=y and img[ii,jj,kk+1]!=label:
-            neighbor.append(img[ii,jj,kk+1])
-        if (kk!=y and jj!=x) and img[ii,jj+1,kk+1]!=label:
-            neighbor.append(img[ii,jj+1,kk+1])
-        if (kk!=y and jj!=0) and img[ii,jj-1,kk+1]!=label:
-            neighbor.append(img[ii,jj-1,kk+1])
-        if (kk!=0 and jj!=x) and img[ii,jj+1,kk-1]!=label:
-            neighbor.append(img[ii,jj+1,kk-1])
-        if (kk!=0 and jj!=0) and img[ii,jj-1,kk-1]!=label:
-            neighbor.append(img[ii,jj-1,kk-1])
-        # z = 1
-        if img[ii+1,jj,kk]!=label:
-            neighbor.append(img[ii+1,jj,kk])
-        if jj!=x and img[ii+1,jj+1,kk]!=label:
-            neighbor.append(img[ii+1,jj+1,kk])
-        if jj!=0 and img[ii+1,jj-1,kk]!=label:
-            neighbor.append(img[ii+1,jj-1,kk])
-        if kk!=0 and img[ii+1,jj,kk-1]!=label:
-            neighbor.append(img[ii+1,jj,kk-1])
-        if kk!=y and img[ii+1,jj,kk+1]!=label:
-            neighbor.append(img[ii+1,jj,kk+1])
-        # z = -1
-        if img[ii-1,jj,kk]!=label:
-            neighbor.append(img[ii-1,jj,kk])
-        if jj!=x and img[ii-1,jj+1,kk]!=label:
-            neighbor.append(img[ii-1,jj+1,kk])
-        if jj!=0 and img[ii-1,jj-1,kk]!=label:
-            neighbor.append(img[ii-1,jj-1,kk])
-        if kk!=0 and img[ii-1,jj,kk-1]!=label:
-            neighbor.append(img[ii-1,jj,kk-1])
-        if kk!=y and img[ii-1,jj,kk+1]!=label:
-            neighbor.append(img[ii-1,jj,kk+1])
-        if len(neighbor)>0:
-            newlabel = max(set(neighbor), key = neighbor.count) # get the highest frequency one
-            if newlabel==Labels['Vein'] or newlabel==Labels['Artery']:
-                if neighbor.count(Labels['Fat'])>neighbor.count(Labels['Glandular']):
-                    newlabel = Labels['Fat']
-                else:
-                    newlabel = Labels['Glandular']
-            new_label_link.append(((ii,jj,kk), newlabel))  
-
+        newlabel = _NeighborVote(img, ii, jj, kk, label)
+        if newlabel is not None:
             #saving the link between position and label
-            #img[ii,jj,kk] = newlabel;
-    
+            new_label_link.append(((ii,jj,kk), newlabel))
+
     #replace labels
     for item in new_label_link:
         pos, newlabel = item
@@ -200,11 +505,232 @@ def RemoveLabel(img, label):
         img[ii,jj,kk] = newlabel
     return img
 
-def SetPropValue(Prop, tissue):
+
+def _VoteChunk(img, zs, xs, ys, label):
+    '''
+    Vectorized 18-neighbor vote for the voxels (zs,xs,ys)
+    Output: (has_neighbor, newlabel), newlabel is only valid where has_neighbor
+    '''
+    z,x,y = img.shape
+    n = len(zs)
+    nb = np.empty((n, len(_NEIGHBORS_18)), 'uint8')
+    for i,(dz,dx,dy) in enumerate(_NEIGHBORS_18):
+        j = xs+dx
+        k = ys+dy
+        outside = (j<0)|(j>=x)|(k<0)|(k>=y)
+        v = img[zs+dz, np.clip(j,0,x-1), np.clip(k,0,y-1)]
+        v[outside] = label # neighbors out of the plane are skipped
+        nb[:,i] = v
+
+    present = np.bincount(nb.ravel(), minlength=256)>0
+    present[label] = False
+    cand = np.flatnonzero(present)
+    if len(cand)==0:
+        return np.zeros(n, bool), np.zeros(n, 'uint8')
+    counts = np.empty((n, len(cand)), 'uint8')
+    for i,c in enumerate(cand):
+        counts[:,i] = np.count_nonzero(nb==c, axis=1)
+    del nb
+
+    n_fat = counts[:,cand==Labels['Fat']].sum(1)
+    n_gland = counts[:,cand==Labels['Glandular']].sum(1)
+    rule = np.where(n_fat>n_gland, Labels['Fat'], Labels['Glandular']).astype('int16')
+    vessel = (cand==Labels['Vein'])|(cand==Labels['Artery'])
+    # label each candidate would turn into if it won the vote
+    outcome = np.where(vessel[None,:], rule[:,None], cand[None,:].astype('int16'))
+
+    best = counts.max(1)
+    tied = counts==best[:,None]
+    lo = np.where(tied, outcome, 256).min(1)
+    hi = np.where(tied, outcome, -1).max(1)
+    has_neighbor = best>0
+    newlabel = lo.astype('uint8')
+
+    # a tie between candidates with different outcomes is broken by the
+    # iteration order of a python set, resolve those voxels one by one
+    for idx in np.flatnonzero(has_neighbor & (lo!=hi)):
+        newlabel[idx] = _NeighborVote(img, zs[idx], xs[idx], ys[idx], label)
+    return has_neighbor, newlabel
+
+
+def RemoveLabel(img, label, chunk_size=1<<20):
+    '''
+    Replace the extra label by its neigbors
+    first, counting the labels frequency in adjacent 18 voxels
+    18 voxels include 5 voxels at above slice, 5 voxels at the below slice, 8 voxels at the current slice
+    then, replace the extra label by the highest frequency label
+    NOTICE: this method can't guarantee the extra label can be removed clearly
+    this function will be executed several times utils all extra labels are removed.
+
+    The label histogram is computed for all the target voxels at once (in chunks
+    of chunk_size voxels), the output is identical to RemoveLabelLoop.
+    '''
+    z_list,x_list,y_list = np.where(img[1:-1]==label)
+    z_list += 1
+    updates = []
+    for s in range(0, len(z_list), chunk_size):
+        zs = z_list[s:s+chunk_size]
+        xs = x_list[s:s+chunk_size]
+        ys = y_list[s:s+chunk_size]
+        has_neighbor, newlabel = _VoteChunk(img, zs, xs, ys, label)
+        updates.append((zs[has_neighbor], xs[has_neighbor], ys[has_neighbor], newlabel[has_neighbor]))
+
+    #replace labels once all the votes are done
+    for zs, xs, ys, newlabel in updates:
+        img[zs,xs,ys] = newlabel
+    return img
+
+def _VesselPasses(img, z0, z1, rank, barrier, check, counts, chunk_size):
+    '''
+    passes of RemoveLabel of Labelprocessing3d on the slices z0:z1 of img
+    (shared by all the processes), see RemoveVesselsParallel
+    '''
+    vessels = {}
+    for label in (Labels['Artery'], Labels['Vein']):
+        zs, xs, ys = np.where(img[z0:z1]==label)
+        vessels[label] = (zs+z0, xs, ys)
+
+    def Pass(label):
+        zs, xs, ys = vessels[label]
+        has_neighbor = np.zeros(len(zs), bool)
+        newlabel = np.zeros(len(zs), 'uint8')
+        for s in range(0, len(zs), chunk_size):
+            chunk = slice(s, s+chunk_size)
+            has_neighbor[chunk], newlabel[chunk] = _VoteChunk(img, zs[chunk], xs[chunk], ys[chunk], label)
+        barrier.wait() # all the slabs voted, the halo slices can change
+        img[zs[has_neighbor], xs[has_neighbor], ys[has_neighbor]] = newlabel[has_neighbor]
+        # the votes never give a vessel label, the voxels left keep theirs
+        vessels[label] = (zs[~has_neighbor], xs[~has_neighbor], ys[~has_neighbor])
+        barrier.wait() # all the slabs are updated
+
+    Pass(Labels['Artery'])
+    Pass(Labels['Vein'])
+    while 1:
+        for label in (Labels['Artery'], Labels['Artery'], Labels['Vein'], Labels['Vein']):
+            Pass(label)
+        counts[2*rank] = len(vessels[Labels['Artery']][0])
+        counts[2*rank+1] = len(vessels[Labels['Vein']][0])
+        check.wait() # the counts of all the slabs are written
+        left = sum(counts[:])
+        check.wait() # and read
+        if left==0:
+            break
+
+
+def _VesselSlab(shm_name, shape, order, z0, z1, rank, barrier, check, counts, chunk_size):
+    '''
+    process of RemoveVesselsParallel
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        _VesselPasses(np.ndarray(shape, 'uint8', buffer=shm.buf, order=order), z0, z1, rank,
+                      barrier, check, counts, chunk_size)
+    except BaseException:
+        # release the other processes
+        barrier.abort()
+        check.abort()
+        raise
+    finally:
+        shm.close()
+
+
+def RemoveVesselsParallel(volume, workers, stats=None, verbose=False, chunk_size=1<<20):
+    '''
+    Iterative Artery/Vein removal of Labelprocessing3d by worker processes,
+    with the same output as the serial passes of RemoveLabel
+    The volume is copied once to shared memory and split into z-slabs, one
+    per process. In every pass, each process votes the vessel voxels of its
+    slab, reading the neighbor slices of the other slabs (halo) from the
+    shared volume, then all the processes write their votes together. The
+    vessel voxels of a slab are listed once and only shrink, so the passes
+    don't scan the volume. Every 4 passes, all the processes stop once no
+    slab has vessel voxels left. If a process dies (e.g. killed when out of
+    memory), the others are stopped and a RuntimeError is raised.
+    volume: 3d label data, modified in place
+    stats: see Labelprocessing3d
+    chunk_size: voxels voted at once by all the processes
+    Output: volume
+    '''
+    if stats is None:
+        stats = {}
+    # the first and last slices are not processed
+    workers = max(min(workers, volume.shape[0]-2), 1)
+    bounds = np.linspace(1, volume.shape[0]-1, workers+1).astype(int)
+    order = 'F' if volume.flags.f_contiguous and not volume.flags.c_contiguous else 'C'
+    ctx = multiprocessing.get_context()
+    barrier = ctx.Barrier(workers)
+    check = ctx.Barrier(workers+1)
+    counts = ctx.Array('q', 2*workers, lock=False)
+    shm = shared_memory.SharedMemory(create=True, size=max(volume.nbytes, 1))
+    img = None
+    processes = []
+    finished = threading.Event()
+
+    def Watch():
+        # a process killed without raising can't abort the barriers itself
+        while not finished.wait(0.2):
+            if any(process.exitcode not in (None, 0) for process in processes):
+                barrier.abort()
+                check.abort()
+                return
+
+    watcher = threading.Thread(target=Watch, daemon=True)
+    try:
+        img = np.ndarray(volume.shape, 'uint8', buffer=shm.buf, order=order)
+        img[...] = volume
+        for rank in range(workers):
+            processes.append(ctx.Process(target=_VesselSlab, args=(
+                shm.name, volume.shape, order, bounds[rank], bounds[rank+1], rank, barrier, check, counts,
+                max(chunk_size//workers, 1))))
+            processes[-1].start()
+        watcher.start()
+        passes = 2
+        remaining = []
+        try:
+            while 1:
+                check.wait()
+                ar = sum(counts[0::2])
+                ve = sum(counts[1::2])
+                check.wait()
+                passes += 4
+                remaining.append([int(ar), int(ve)])
+                if verbose:
+                    print ('removal pass', passes, 'artery', ar, 'vein', ve)
+                if ar==0 and ve==0:
+                    break
+        except threading.BrokenBarrierError:
+            pass
+        for process in processes:
+            process.join()
+        if any(process.exitcode!=0 for process in processes):
+            raise RuntimeError('a vessel removal process failed, exit codes %s'
+                               % [process.exitcode for process in processes])
+        volume[...] = img
+    finally:
+        finished.set()
+        barrier.abort()
+        check.abort()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        img = None
+        shm.close()
+        shm.unlink()
+    stats['removal_passes'] = passes
+    stats['remaining_vessels'] = remaining
+    return volume
+
+@functools.lru_cache(maxsize=64)
+def _TruncNorm(mu, sigma, lw, up):
+    return stats.truncnorm((lw-mu)/sigma, (up-mu)/sigma, loc=mu, scale=sigma)
+
+
+def SetPropValue(Prop, tissue, rng=None):
     '''
     Assign acoustic properties to label data
     Acoustic value is sampling from turncated gaussian distribution
     mean values, std values are defined in config.py file
+    rng: numpy Generator to draw from, the global numpy random state if None
     '''
     if type(Prop)==int or type(Prop)==float:
         return Prop
@@ -212,9 +738,251 @@ def SetPropValue(Prop, tissue):
     sigma = float(Prop['sd'])
     lw = float(Prop['min'])
     up = float(Prop['max'])
-    X = stats.truncnorm((lw-mu)/sigma, (up-mu)/sigma, loc=mu, scale=sigma)
-    val = X.rvs(1)
-    return float(val)
+    X = _TruncNorm(mu, sigma, lw, up)
+    val = X.rvs(1, random_state=rng)
+    return float(val[0])
+
+
+def PropertyTables(rng=None):
+    '''
+    Draw the acoustic properties of every tissue (see SetPropValue) and
+    store them in 256-entry lookup tables indexed by label value
+    labels without properties in config.py map to 0
+    rng: numpy Generator to draw from, the global numpy random state if None
+    Output: sos, density, attenuation tables (float32)
+    '''
+    lut_sos = np.zeros(256, 'float32')
+    lut_density = np.zeros(256, 'float32')
+    lut_atten = np.zeros(256, 'float32')
+    for key in SOS:
+        lut_sos[Labels[key]] = SetPropValue(SOS[key], key, rng)
+        lut_density[Labels[key]] = SetPropValue(Density[key], key, rng)
+        lut_atten[Labels[key]] = SetPropValue(Atten[key], key, rng)
+    return lut_sos, lut_density, lut_atten
+
+
+def RegionIndex(volume, tissues=None, connectivity=1):
+    '''
+    Index of the connected regions of the tissues
+    Every connected component of a tissue (e.g. a fat lobule) gets its own
+    index, from 256 on, the other voxels keep their label value as index.
+    Input:
+    volume: uint8 label data
+    tissues: tissues split into regions, by default those with a
+             distribution (dict) in SOS, Density or Atten of config.py
+    connectivity: 1 (faces) to volume.ndim (corners), see
+                  scipy.ndimage.generate_binary_structure
+    Output: int32 index map, uint8 label of every region (length n regions)
+    '''
+    if tissues is None:
+        tissues = [key for key in Labels
+                   if any(isinstance(prop.get(key), dict) for prop in (SOS, Density, Atten))]
+    structure = scipy.ndimage.generate_binary_structure(volume.ndim, connectivity)
+    index = volume.astype('int32')
+    regions = []
+    offset = 256
+    for key in tissues:
+        comp, n = scipy.ndimage.label(volume==Labels[key], structure, output='int32')
+        if n==0:
+            continue
+        np.add(comp, offset-1, out=index, where=comp>0)
+        del comp
+        regions.append(np.full(n, Labels[key], 'uint8'))
+        offset += n
+    regions = np.concatenate(regions) if regions else np.zeros(0, 'uint8')
+    return index, regions
+
+
+def RegionTables(regions, rng=None):
+    '''
+    Draw the acoustic properties of every region (see RegionIndex), one
+    vectorized truncated gaussian draw per property for all the regions
+    Input:
+    regions: label of every region
+    rng: numpy Generator to draw from, the global numpy random state if None
+    Output: sos, density, attenuation tables (float32), indexed by the
+            index map of RegionIndex: the first 256 entries (labels) as in
+            PropertyTables, then one entry per region
+    '''
+    tables = PropertyTables(rng)
+    out = []
+    for prop, lut in zip((SOS, Density, Atten), tables):
+        mu, sigma, lw, up = np.zeros((4, 256))
+        random = np.zeros(256, bool)
+        for key, value in prop.items():
+            if isinstance(value, dict):
+                random[Labels[key]] = True
+                mu[Labels[key]] = value['mean']; sigma[Labels[key]] = value['sd']
+                lw[Labels[key]] = value['min']; up[Labels[key]] = value['max']
+        values = lut[regions]
+        sel = random[regions]
+        if sel.any():
+            r = regions[sel]
+            X = stats.truncnorm((lw[r]-mu[r])/sigma[r], (up[r]-mu[r])/sigma[r], loc=mu[r], scale=sigma[r])
+            values[sel] = X.rvs(random_state=rng)
+        out.append(np.concatenate((lut, values)).astype('float32'))
+    return tuple(out)
+
+
+def AssignProperties(volume, out=None, tables=None, workers=1):
+    '''
+    Assign acoustic properties to label data by table lookup
+    Input:
+    volume: uint8 label data, or int32 index map of RegionIndex
+    out: optional (sos, density, attenuation) float32 arrays of the volume
+         shape to write into, e.g. to reuse buffers across a batch
+    tables: optional lookup tables, drawn by PropertyTables if not given
+            (RegionTables for an index map)
+    workers: number of threads, each one fills a range of slices
+    Output: sos, density, attenuation maps
+    '''
+    assert(volume.dtype==np.uint8 or tables is not None) # labels index the 256-entry tables
+    if tables is None:
+        tables = PropertyTables()
+    if out is None:
+        out = [np.empty(volume.shape, 'float32') for _ in tables]
+    bounds = np.linspace(0, volume.shape[0], min(max(workers,1), volume.shape[0])+1).astype(int)
+    jobs = [(lut, buf, a, b) for lut, buf in zip(tables, out) for a, b in zip(bounds[:-1], bounds[1:])]
+    def take(job):
+        lut, buf, a, b = job
+        np.take(lut, volume[a:b], out=buf[a:b], mode='clip')
+    Parallel(take, jobs, workers)
+    return tuple(out)
+
+
+def Parallel(func, items, workers=1):
+    '''
+    [func(item) for item in items], run by a pool of workers threads
+    numpy, scipy.ndimage and scipy.fft release the GIL in their kernels
+    '''
+    if workers is None or workers<=1 or len(items)<=1:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(func, items))
+
+
+def ZoomBox(shape, factor, crop=None):
+    '''
+    Part of the output of scipy.ndimage.zoom(whole volume, factor) that can
+    be interpolated from a box of the whole volume
+    Input:
+    shape: shape of the box
+    crop: (offset, shape) of the box in the whole volume, None if the box
+          is the whole volume
+    Output: offset and shape of the output box, shape of the whole output,
+            zoom scale (input voxels per output voxel, as in scipy)
+    '''
+    offset, whole = crop if crop is not None else ((0,)*len(shape), shape)
+    out_offset, out_shape, out_whole, scales = [], [], [], []
+    for a, n, N in zip(offset, shape, whole):
+        M = int(round(N*factor))
+        scale = (N-1)/float(M-1) if M>1 else 1.
+        j0 = int(math.ceil(a/scale-1e-9)) if a>0 else 0
+        j1 = int(math.floor((a+n-1)/scale+1e-9))+1 if a+n<N else M
+        out_offset.append(j0); out_shape.append(max(min(j1, M)-j0, 0)); out_whole.append(M); scales.append(scale)
+    return out_offset, out_shape, out_whole, scales
+
+
+def Zoom(data, factor, crop=None, output=None, **kwargs):
+    '''
+    scipy.ndimage.zoom(data, factor, output, **kwargs), or if data is a box
+    crop=(offset, shape) of a larger volume, the part of the zoom of that
+    volume covered by the box (see ZoomBox), on the same output grid
+    '''
+    if crop is None:
+        return scipy.ndimage.zoom(data, factor, output=output, **kwargs)
+    out_offset, out_shape, _, scales = ZoomBox(data.shape, factor, crop)
+    shift = [j0*s-a for j0, s, a in zip(out_offset, scales, crop[0])]
+    return scipy.ndimage.affine_transform(data, scales, shift, output_shape=tuple(out_shape), output=output,
+                                          **kwargs)
+
+
+def ResampleMaps(map_sos, map_density, map_atten, volume, factor, workers=1, mode='zoom', crop=None):
+    '''
+    Resample the property maps and the label map by factor
+    mode: 'zoom' cubic spline for the properties, zoom for the labels
+          (the four maps are resampled concurrently if workers>1)
+          'block' block mean for the properties and majority vote for the
+          labels (see BlockReduce), only for integer downsampling factors,
+          falls back to 'zoom' otherwise
+    crop: optional (offset, shape) of the maps in a larger volume, they are
+          zoomed on the output grid of that volume (see Zoom); for 'block',
+          the offset must be a multiple of the block size
+    '''
+    block = BlockFactor(factor)
+    if mode=='block' and block is not None:
+        volume, map_sos, map_density, map_atten = BlockReduce(volume, block,
+                maps=(map_sos, map_density, map_atten), workers=workers)
+        return map_sos, map_density, map_atten, volume
+    jobs = [(map_sos, {}), (map_density, {}), (map_atten, {}), (volume, {'mode':'nearest'})]
+    return tuple(Parallel(lambda job: Zoom(job[0], factor, crop, **job[1]), jobs, workers))
+
+
+def BlockFactor(factor):
+    '''
+    Block size of a downsampling by factor (<=1), None if 1/factor isn't an integer
+    '''
+    block = int(round(1./factor))
+    if block<1 or abs(block*factor-1)>1e-6:
+        return None
+    return block
+
+
+def BlockReduce(volume, block, tables=(), maps=(), workers=1, out=None):
+    '''
+    Downsample by an integer factor along every axis in one pass
+    the label histogram of every block (of block^ndim voxels, partial at
+    the upper ends) gives both the majority label, ties going to the
+    lowest label value, and the block mean of the table properties.
+    Input:
+    volume: uint8 label data
+    block: integer downsampling factor
+    tables: property lookup tables (see PropertyTables), whose block means
+            are computed from the histogram without full-resolution maps
+    maps: arrays of the volume shape, whose block means are computed
+    workers: number of threads, each one reduces a range of slices
+    out: optional float32 arrays of the output shape receiving the block
+         means of the tables and maps, e.g. to reuse buffers
+    Output: labels, block means of the tables properties, block means of maps
+    '''
+    assert(volume.dtype==np.uint8)
+    shape = volume.shape
+    oshape = tuple(-(-n//block) for n in shape)
+    label_out = np.empty(oshape, 'uint8')
+    if out is None:
+        out = [np.empty(oshape, 'float32') for _ in list(tables)+list(maps)]
+    outs = list(out)
+    ctype = 'uint16' if block**len(shape)<2**16 else 'uint32'
+
+    def reduce(bounds):
+        a, b = bounds
+        vol = volume[a*block:b*block]
+        sub_maps = [m[a*block:b*block] for m in maps]
+        cand = np.flatnonzero(np.bincount(vol.ravel(), minlength=256))
+        osub = (b-a,)+oshape[1:]
+        counts = np.zeros((len(cand),)+osub, ctype)
+        sums = [np.zeros(osub, 'float64') for _ in maps]
+        for off in itertools.product(range(block), repeat=len(shape)):
+            sl = tuple(slice(o, None, block) for o in off)
+            sub = vol[sl]
+            if sub.size==0:
+                continue
+            dst = tuple(slice(0, n) for n in sub.shape)
+            for k, c in enumerate(cand):
+                counts[(k,)+dst] += sub==c
+            for acc, m in zip(sums, sub_maps):
+                acc[dst] += m[sl]
+        total = counts.sum(0)
+        label_out[a:b] = cand[counts.argmax(0)]
+        for lut, out in zip(tables, outs):
+            out[a:b] = np.tensordot(lut[cand], counts, 1)/total
+        for acc, out in zip(sums, outs[len(tables):]):
+            out[a:b] = acc/total
+
+    bounds = np.linspace(0, oshape[0], min(max(workers,1), oshape[0])+1).astype(int)
+    Parallel(reduce, list(zip(bounds[:-1], bounds[1:])), workers)
+    return tuple([label_out]+outs)
+
 
 def sampler2D(b, kappa, h):
     '''
@@ -266,63 +1034,218 @@ def sampler3D(b, kappa, h):
     return m
 
 
-def AddTexture3D(sos, density, label):
+@functools.lru_cache(maxsize=4)
+def GaussKernel(shape, kappa, h):
+    '''
+    gauss spectral function exp(-kappa^2*|k|^2/8) on the rfftn grid of an
+    array of the given shape (half spectrum along the last axis)
+    the kernel is separable, it is returned as the factors (first axis,
+    other axes) whose broadcast product is the kernel, so that the cache
+    only holds a 1d vector and one slice per (shape, kappa, h) and not a
+    full-volume spectrum. The returned arrays are read-only.
+    kappa: correlation length [mm]
+    h: pixel size[mm]
+    '''
+    factors = []
+    for axis, n in enumerate(shape):
+        if axis==len(shape)-1:
+            k = np.fft.rfftfreq(n, 1./n)
+        else:
+            k = np.fft.fftfreq(n, 1./n)
+        k = (2*math.pi/float(n*h))*k
+        d = np.exp(-kappa*kappa*k*k/8).astype('float32')
+        factors.append(d.reshape([-1 if i==axis else 1 for i in range(len(shape))]))
+    plane = functools.reduce(np.multiply, factors[1:], np.ones((1,)*len(shape), 'float32'))
+    for factor in (factors[0], plane):
+        factor.flags.writeable = False
+    return factors[0], plane
+
+
+def GaussTexture(b, kappa, h, workers=None):
+    '''
+    same texture signal as sampler2D/sampler3D, computed in single precision
+    with real FFTs and the cached kernel factors of GaussKernel
+    b: input whitenoise (2d or 3d)
+    kappa: correlation length [mm]
+    h: pixel size[mm]
+    workers: number of threads of the FFTs
+    '''
+    b = np.asarray(b, 'float32')
+    bhat = scipy.fft.rfftn(b, workers=workers)
+    for factor in GaussKernel(b.shape, kappa, h):
+        bhat *= factor
+    return scipy.fft.irfftn(bhat, s=b.shape, overwrite_x=True, workers=workers)
+
+
+def WhiteNoise(shape, rvs):
+    '''
+    float32 white noise drawn slice by slice along the first axis
+    rvs: function returning float64 samples of a given shape
+    '''
+    b = np.empty(shape, 'float32')
+    for i in range(shape[0]):
+        b[i] = rvs(shape[1:])
+    return b
+
+
+@functools.lru_cache(maxsize=1)
+def _FatNoiseDist():
+    mean = 0; sigma =1; lw = mean-0.9*sigma; up = mean+0.9*sigma;
+    return stats.truncnorm((lw-mean)/sigma, (up-mean)/sigma, loc=mean, scale=sigma)
+
+
+def _TextureNoise(rng=None):
+    '''
+    noise generators of the gland (gaussian) and fat (truncated gaussian) textures
+    rng: numpy Generator to draw from, the global numpy random state if None
+    '''
+    X = _FatNoiseDist()
+    if rng is None:
+        gland = lambda shape: np.random.normal(0,1,shape)
+        fat = lambda shape: X.rvs(shape)
+    else:
+        gland = lambda shape: rng.standard_normal(shape)
+        fat = lambda shape: X.rvs(shape, random_state=rng)
+    return gland, fat
+
+
+# (property index: 0 sos 1 density, tissue, noise index: 0 gland 1 fat, scale)
+# adjust std to 2%:
+# mapping current disribution to truncated guassian distribution
+_TEXTURE_FIELDS = ((0, 'Glandular', 0, 1451),   # gland sos
+                   (1, 'Glandular', 0, 999),    # gland dens
+                   (0, 'Fat', 1, 1420),         # fat sos
+                   (1, 'Fat', 1, 915))          # fat dens
+
+
+def AddTexture3D(sos, density, label, kappa=0.21, h=0.1, tile_shape=None, seed=None, workers=1, rng=None):
     '''
     add texture to sos and density map
     Input:
     sos: sos map
     density: density map
     label: label map
+    kappa: correlation length [mm]
+    h: pixel size[mm]
+    tile_shape: if given, generate the texture tile by tile (see
+                AddTextureTiled) instead of whole-volume FFTs
+    seed: seed of the tiled texture noise
+    workers: number of threads
+    rng: numpy Generator of the texture noise (and of the tiled texture
+         seed if not given), the global numpy random state if None
+
+    The four texture fields (gland/fat sos and density) are generated by
+    GaussTexture, sharing the cached spectral kernel. With workers>1, up
+    to four fields are filtered concurrently (their noise is still drawn
+    in order from the numpy random state), each FFT using the remaining
+    threads; this holds the noise of all the concurrent fields in memory.
+    The texture is added in place through boolean masks of the tissues.
     '''
-  
+    if tile_shape is not None:
+        if seed is None and rng is not None:
+            seed = int(rng.integers(2**31))
+        return AddTextureTiled(sos, density, label, tile_shape, seed, kappa, h, workers)
     vshape = sos.shape
-    #gland_dens_rn = np.random.normal(0,1,vshape)
-    mean = 0; sigma =1; lw = mean-0.9*sigma; up = mean+0.9*sigma;
-    X = stats.truncnorm((lw-mean)/sigma, (up-mean)/sigma, loc=mean, scale=sigma)
-    #b3 = np.random.normal(0,1,(2560,2560))
-    #b4 = np.random.normal(0,1,(2560,2560))
-    indices_fat = np.where(label==Labels['Fat'])
-    indices_gland = np.where(label==Labels['Glandular'])
-
-    #fat_sos_rn = X.rvs(vshape)
-    #fat_dens_rn = X.rvs(vshape)
-    kappa = 0.21; h = 0.1 #mm
-
-    rn = np.random.normal(0,1,vshape)
-    if len(rn.shape)==2:
-        text = sampler2D(rn, kappa, h)
-    else:
-        text =sampler3D(rn, kappa, h) # for gland sos
-    text = text*1451*0.02
-    sos[indices_gland] = sos[indices_gland]+text[indices_gland] #gland sos
-    
-
-    rn = np.random.normal(0,1,vshape)
-    if len(rn.shape)==2:
-        text = sampler2D(rn, kappa, h)
-    else:
-        text =sampler3D(rn, kappa, h)  # for gland dens
-    text = text*999*0.02
-    density[indices_gland] = density[indices_gland]+text[indices_gland] #gland dens
-
-    rn = X.rvs(vshape)
-    if len(rn.shape)==2:
-        text = sampler2D(rn, kappa, h)
-    else:    
-        text =sampler3D(rn, kappa, h)  # for fat sos
-    text = text*1420*0.02
-    sos[indices_fat] = sos[indices_fat]+text[indices_fat] # fat sos
-
-    rn = X.rvs(vshape)
-    if len(rn.shape)==2:
-        text = sampler2D(rn, kappa, h)
-    else:
-        text =sampler3D(rn, kappa, h)  # for fat dens
-    # texture = texture;
-    # adjust std to 2%:
-    # mapping current disribution to truncated guassian distribution
-    # sigma1 = 1440*0.02; sigma2 = 911*0.02
-    text = text*915*0.02
-    density[indices_fat] = density[indices_fat]+text[indices_fat] #fat dens
+    props = (sos, density)
+    noises = _TextureNoise(rng)
+    nfields = min(max(workers,1), len(_TEXTURE_FIELDS))
+    fft_workers = max(workers//nfields, 1)
+    for i in range(0, len(_TEXTURE_FIELDS), nfields):
+        fields = _TEXTURE_FIELDS[i:i+nfields]
+        b = [WhiteNoise(vshape, noises[noise]) for _, _, noise, _ in fields]
+        texts = Parallel(lambda b: GaussTexture(b, kappa, h, fft_workers), b, nfields)
+        del b
+        for (prop, tissue, noise, scale), text in zip(fields, texts):
+            text *= scale*0.02
+            np.add(props[prop], text, out=props[prop], where=label==Labels[tissue])
+        del texts
     return sos, density
 
+
+# edge length of the blocks the tiled texture noise is drawn by
+NOISE_BLOCK = 32
+
+
+@functools.lru_cache(maxsize=8)
+def GaussTaps(kappa, h):
+    '''
+    1d filter taps of the gauss spectral function exp(-kappa^2*k^2/8)
+    (one separable factor of GaussKernel), truncated at 5 standard deviations
+    kappa: correlation length [mm]
+    h: pixel size[mm]
+    '''
+    radius = int(math.ceil(5*kappa/(2.*h)))
+    n = max(64, 8*radius)
+    k = (2*math.pi/float(n*h))*np.fft.fftfreq(n, 1./n)
+    taps = np.real(fft.ifft(np.exp(-kappa*kappa*k*k/8)))
+    return np.concatenate((taps[-radius:], taps[:radius+1]))
+
+
+def NoiseRegion(shape, start, stop, seed, field, noise):
+    '''
+    white noise of the box [start, stop) of a volume of the given shape
+    the volume is periodic, the box may extend beyond its bounds.
+    The noise is drawn by blocks of NOISE_BLOCK voxels, each seeded from
+    (seed, field, block position), so a voxel value only depends on its
+    global position and not on the requested box.
+    noise: 0 gland (gaussian) 1 fat (truncated gaussian)
+    '''
+    coords = [np.arange(a, b)%n for a, b, n in zip(start, stop, shape)]
+    blocks = [c//NOISE_BLOCK for c in coords]
+    out = np.empty([len(c) for c in coords], 'float32')
+    for block in itertools.product(*[np.unique(b) for b in blocks]):
+        rng = np.random.default_rng([seed, field]+[int(b) for b in block])
+        bshape = [min(NOISE_BLOCK, n-b*NOISE_BLOCK) for b, n in zip(block, shape)]
+        values = _TextureNoise(rng)[noise](bshape)
+        sel = [np.flatnonzero(bl==b) for bl, b in zip(blocks, block)]
+        src = [c[s]-b*NOISE_BLOCK for c, s, b in zip(coords, sel, block)]
+        out[np.ix_(*sel)] = values[np.ix_(*src)]
+    return out
+
+
+def TextureTile(shape, start, stop, seed, field, noise, kappa=0.21, h=0.1):
+    '''
+    texture of the box [start, stop) of a volume of the given shape
+    the noise of the box plus a halo of the filter radius is filtered by
+    separable convolutions with GaussTaps, so the values don't depend on
+    the tiling. Up to the filter truncation, this matches GaussTexture of
+    the whole-volume noise (the volume is periodic as with the FFT).
+    '''
+    taps = GaussTaps(kappa, h)
+    radius = len(taps)//2
+    b = NoiseRegion(shape, [a-radius for a in start], [c+radius for c in stop], seed, field, noise)
+    for axis in range(b.ndim):
+        b = scipy.ndimage.correlate1d(b, taps, axis=axis, output=np.float32, mode='wrap')
+    return b[tuple(slice(radius, -radius) for _ in shape)]
+
+
+def AddTextureTiled(sos, density, label, tile_shape, seed=None, kappa=0.21, h=0.1, workers=1):
+    '''
+    add texture to sos and density map, tile by tile
+    the memory used is set by the tile size, sos and density can be
+    memory-mapped arrays. Tiles that contain neither fat nor glandular
+    tissue are skipped.
+    Input:
+    sos, density, label: as in AddTexture3D
+    tile_shape: tile size (voxels), an int or one size per axis
+    seed: seed of the texture noise, drawn from the numpy random state if None
+    workers: number of threads, tiles are processed concurrently
+    '''
+    if seed is None:
+        seed = np.random.randint(2**31)
+    shape = sos.shape
+    tile_shape = np.broadcast_to(tile_shape, (len(shape),))
+    props = (sos, density)
+    def tile(start):
+        stop = [min(a+t, n) for a, t, n in zip(start, tile_shape, shape)]
+        sl = tuple(slice(a, b) for a, b in zip(start, stop))
+        lab = label[sl]
+        for field, (prop, tissue, noise, scale) in enumerate(_TEXTURE_FIELDS):
+            mask = lab==Labels[tissue]
+            if not mask.any():
+                continue
+            text = TextureTile(shape, start, stop, seed, field, noise, kappa, h)
+            text *= scale*0.02
+            np.add(props[prop][sl], text, out=props[prop][sl], where=mask)
+    Parallel(tile, list(itertools.product(*[range(0, n, t) for n, t in zip(shape, tile_shape)])), workers)
+    return sos, density
@@ -0,0 +1,294 @@
+# Copyright (c) 2021,  University of Illinois Urbana-Champaign
+# & Washington University in St Louis.
+#
+#
+# This file is part of the usct-breast-phantom library. For more information and
+# source code
+# availability see https://github.com/comp-imaging-sci/usct-breast-phantom.
+#
+# usct-breast-phantom is free software; you can redistribute it and/or modify it
+# under the
+# terms of the GNU General Public License (as published by the Free
+# Software Foundation) version 2.0 dated June 1991.
+
+
+'''
+Long-lived worker processing slice jobs from a queue
+
+The worker keeps the cleaned full label volumes of the recently used
+phantoms in memory (least recently used first out, under a memory limit),
+so that a job of a resident phantom only costs its properties, resampling,
+texture and output. Jobs are read from
+- a directory: every job is a file <queue_dir>/<name>.json, claimed by
+  renaming it to <name>.running (several workers can share a directory),
+  its result is written to <name>.result
+- a Unix socket: every job is a json line, answered by the json line of
+  its result once done
+
+Job (json), options as in run_assign_properties.py (see JOB_DEFAULTS):
+{
+    "phantom_id": "324402160",
+    "raw_data_path": "./data/Phantom_set",
+    "output_path": "./data/acoustic_phantom",
+    "target_slice": 25,     # mm, -1 for the full volume
+    "thickness": 0,         # mm
+    "resolution": 0.1       # mm
+}
+the maps are saved with the tag z{slice}_t{thickness}_r{resolution} (in
+voxels) as by run_batch.py. {"stop": true} stops the worker.
+
+Result: status ('done', 'failed' with error, 'stopped'), tag, queue_wait_s
+(submission to start of the job), service_s, label_s (part of service_s
+spent getting the cleaned labels), resident (labels were in memory) and,
+with "report": true, the stage records.
+'''
+
+from .config import *
+from .batch import SlabFromCleaned, _ProcessSlice
+from .cache import GetCleanVolume
+from .utils import ReadMetaHeader
+import collections
+import glob
+import json
+import numpy as np
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import traceback
+
+__all__ = ['JOB_DEFAULTS', 'PhantomWorker', 'ServeDirectory', 'ServeSocket', 'SubmitJob']
+
+JOB_DEFAULTS = {
+    'target_slice': -1,
+    'thickness': 0,
+    'resolution': 0.1,
+    'seed': None,
+    'downsampling': 'zoom',
+    'texture_tile': None,
+    'output_format': 'mat',
+    'compression': None,
+    'region_properties': False,
+    'report': False,
+    'tag': None,
+}
+
+
+class PhantomWorker(object):
+    '''
+    Processes jobs (see the module description), keeping the cleaned label
+    volumes resident
+    '''
+
+    def __init__(self, memory_limit=None, label_removal='iterative', cache=None, threads=1, verbose=True,
+                 cleanup_workers=1):
+        '''
+        memory_limit: bytes of the resident label volumes, the least recently
+                      used are released to load a new one (counted twice
+                      while it is decoded and cleaned)
+        label_removal: 'iterative' or 'nearest'
+        cache: optional LabelCache of the cleaned volumes
+        threads: threads of the property and texture stages
+        cleanup_workers: processes of the vessel removal (see Labelprocessing3d)
+        '''
+        self.memory_limit = memory_limit
+        self.label_removal = label_removal
+        self.cache = cache
+        self.threads = threads
+        self.verbose = verbose
+        self.cleanup_workers = cleanup_workers
+        self.volumes = collections.OrderedDict() # (raw_data_path, phantom_id) -> (cleaned, dz)
+
+    def ResidentBytes(self):
+        return sum(cleaned.nbytes for cleaned, _ in self.volumes.values())
+
+    def Volume(self, raw_data_path, phantom_id):
+        '''
+        cleaned full label volume of the phantom (as GetCleanVolume(zz=-1))
+        Output: cleaned, z voxel size (mm), whether it was resident
+        '''
+        key = (os.path.abspath(raw_data_path), phantom_id)
+        if key in self.volumes:
+            self.volumes.move_to_end(key)
+            return self.volumes[key]+(True,)
+        header = ReadMetaHeader(os.path.join(raw_data_path, 'p_'+phantom_id+'.mhd'))
+        nbytes = int(np.prod(header['DimSize']))
+        if self.memory_limit is not None:
+            while self.volumes and self.ResidentBytes()+2*nbytes>self.memory_limit:
+                self.volumes.popitem(last=False)
+            if 2*nbytes>self.memory_limit:
+                print ('phantom', phantom_id, 'alone exceeds the memory limit')
+        cleaned = GetCleanVolume(raw_data_path, phantom_id, -1, 0, self.label_removal, self.cache,
+                                 cleanup_workers=self.cleanup_workers)
+        dz = header['ElementSpacing'][0]
+        if self.memory_limit is None or cleaned.nbytes<=self.memory_limit:
+            self.volumes[key] = (cleaned, dz)
+        return cleaned, dz, False
+
+    def Run(self, job, submitted=None):
+        '''
+        process a job
+        submitted: time.time() of the submission, for the queue wait
+        Output: result (see the module description)
+        '''
+        start = time.time()
+        result = {'queue_wait_s': max(start-submitted, 0) if submitted is not None else 0.}
+        try:
+            opts = dict(JOB_DEFAULTS, **job)
+            phantom_id = str(opts['phantom_id'])
+            cleaned, dz, resident = self.Volume(opts['raw_data_path'], phantom_id)
+            result.update(resident=resident, label_s=time.time()-start)
+            # target slice and half thickness in voxels, as in run_assign_properties.py
+            zz = int(opts['target_slice']/dz) if opts['target_slice']>=0 else -1
+            th = int(opts['thickness']/(2*dz))
+            tag = opts['tag'] or 'z'+str(zz)+'_t'+str(th)+'_r'+str(opts['resolution'])
+            newfolder = os.path.join(opts['output_path'], phantom_id)
+            if not os.path.exists(newfolder):
+                os.makedirs(newfolder, exist_ok=True)
+            volume = np.array(SlabFromCleaned(cleaned, zz, th))
+            del cleaned
+            _, stages = _ProcessSlice(volume, dict(opts, phantom_id=phantom_id, zz=zz, thickness=th, tag=tag,
+                                                   threads=self.threads, input_voxel_size=dz))
+            result.update(status='done', tag=tag)
+            if opts['report']:
+                result['stages'] = stages
+        except Exception as error:
+            result.update(status='failed', error=repr(error), traceback=traceback.format_exc())
+        result['service_s'] = time.time()-start
+        if self.verbose:
+            print ('%s %s: queue wait %.3f s, service %.3f s%s' % (
+                result['status'], result.get('tag', job.get('phantom_id')), result['queue_wait_s'],
+                result['service_s'], ' (resident labels)' if result.get('resident') else ''))
+        return result
+
+
+def _CheckJob(job):
+    '''
+    a job must be a json object, ValueError otherwise (answered as failed)
+    '''
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a json object, not %r' % (job,))
+    return job
+
+
+def _Log(log, result):
+    if log is not None:
+        with open(log, 'a') as fid:
+            fid.write(json.dumps(result, default=float)+'\n')
+
+
+def ServeDirectory(worker, queue_dir, poll=1.0, exit_when_empty=False, log=None):
+    '''
+    Process the jobs of queue_dir, oldest first, until a stop job
+    poll: seconds between two scans of an empty queue
+    exit_when_empty: return once the queue is empty
+    log: file to which the result of every job is appended (json lines)
+    '''
+    while True:
+        pending = []
+        for path in glob.glob(os.path.join(queue_dir, '*.json')):
+            try:
+                pending.append((os.path.getmtime(path), path))
+            except OSError: # claimed by another worker
+                pass
+        if not pending:
+            if exit_when_empty:
+                return
+            time.sleep(poll)
+            continue
+        for mtime, path in sorted(pending):
+            running = path[:-len('.json')]+'.running'
+            try:
+                os.rename(path, running)
+            except OSError: # claimed by another worker
+                continue
+            try:
+                with open(running) as fid:
+                    job = _CheckJob(json.load(fid))
+            except ValueError as error:
+                job, result = {}, {'status': 'failed', 'error': repr(error)}
+            else:
+                if job.get('stop'):
+                    result = {'status': 'stopped'}
+                else:
+                    result = worker.Run(job, job.get('submitted', mtime))
+            result['job'] = os.path.basename(path)
+            fd, tmp = tempfile.mkstemp('.tmp', dir=queue_dir)
+            with os.fdopen(fd, 'w') as fid:
+                json.dump(result, fid, default=float)
+            os.replace(tmp, path[:-len('.json')]+'.result')
+            os.remove(running)
+            _Log(log, result)
+            if job.get('stop'):
+                return
+
+
+def ServeSocket(worker, socket_path, log=None):
+    '''
+    Process the jobs sent to the Unix socket socket_path, in their order
+    of arrival, until a stop job
+    log: file to which the result of every job is appended (json lines)
+    '''
+    jobs = queue.Queue()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    entry = {'job': _CheckJob(json.loads(line)), 'submitted': time.time(), 'done': threading.Event()}
+                except ValueError as error:
+                    result = {'status': 'failed', 'error': repr(error)}
+                else:
+                    jobs.put(entry)
+                    entry['done'].wait()
+                    result = entry['result']
+                self.wfile.write((json.dumps(result, default=float)+'\n').encode())
+                self.wfile.flush()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        while True:
+            entry = jobs.get()
+            if entry['job'].get('stop'):
+                entry['result'] = {'status': 'stopped'}
+            else:
+                entry['result'] = worker.Run(entry['job'], entry['submitted'])
+            _Log(log, entry['result'])
+            entry['done'].set()
+            if entry['job'].get('stop'):
+                break
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+
+
+def SubmitJob(queue_path, job):
+    '''
+    Submit a job to a worker
+    queue_path: queue directory, or Unix socket of the worker
+    Output: job file (directory), or result of the job (socket, waits for it)
+    '''
+    if os.path.isdir(queue_path):
+        # written under another name, then renamed, so that workers never read a partial job
+        fd, tmp = tempfile.mkstemp('.tmp', 'job_', dir=queue_path)
+        with os.fdopen(fd, 'w') as fid:
+            json.dump(dict(job, submitted=time.time()), fid)
+        path = tmp[:-len('.tmp')]+'.json'
+        os.rename(tmp, path)
+        return path
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(queue_path)
+        sock.sendall((json.dumps(job)+'\n').encode())
+        with sock.makefile('r') as fid:
+            return json.loads(fid.readline())